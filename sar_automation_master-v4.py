@@ -29,41 +29,583 @@
 ###############################################################################################################################"""
 
 ## import all the necessary libraries
-import os,requests,multiprocessing,configparser,csv,boto3
-import gspread,json,getpass,sys
-from apiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
-from apiclient.http import MediaFileUpload
+import time
+#taken before anything else is loaded so the startup cost of a run can be measured
+SCRIPT_STARTED = time.perf_counter()
+import os,configparser,atexit,argparse
+import json,sys,threading,random,re,copy,math,signal,tempfile,socket,itertools,shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
 
 ################################################################################################################################
 ########################Function definitions#####################################
 
+#the most calls the Drive API accepts in one batch HTTP request
+DRIVE_BATCH_SIZE = 100
+
+#what Drive calls an .xlsx file and a Google spreadsheet
+XLSX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+SPREADSHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+#the most files Drive returns in one page of files.list
+DRIVE_LIST_PAGE_SIZE = 1000
+
+#the Google client libraries are slow to import so they are only loaded when a client
+#is first made. A run with nothing to do never loads gspread at all
+
+class CredentialCache(object):
+    '''loads each service account key file once and hands the same credentials to every client
+    made from it. Drive and Sheets clients on every thread then share one access token, which
+    is refreshed once when it runs out rather than once per client'''
+
+    def __init__(self,scopes):
+        self.scopes = list(scopes)
+        self.credentials = {}
+        self.lock = threading.Lock()
+
+    def get(self,keyFilePath):
+        keyFilePath = os.path.abspath(keyFilePath)
+        with self.lock:
+            if keyFilePath not in self.credentials:
+                from google.oauth2.service_account import Credentials
+                self.credentials[keyFilePath] = Credentials.from_service_account_file(
+                    keyFilePath,scopes=self.scopes)
+            return self.credentials[keyFilePath]
+
+
+#discovery documents already read from the cache directory, by path
+discoveryDocuments = {}
+
 # Function to connect to the Google Service API
-def get_google_service(api_name, api_version, scopes, key_file_location):
+def get_google_service(api_name, api_version, scopes, key_file_location, discoveryCacheDir=None,
+                       credentials=None, timeout=60):
     """Get a service that communicates to a Google API.
         Args:
             api_name: The name of the api to connect to.
             api_version: The api version to connect to.
             scopes: A list auth scopes to authorize for the application.
             key_file_location: The path to a valid service account JSON key file.
+            discoveryCacheDir: Where the API's discovery document is kept. The service is
+                built from the saved document, with no discovery round trip, once it is there.
+            credentials: Credentials to use instead of loading key_file_location, so that
+                several services can share one token.
+            timeout: Socket timeout in seconds.
         Returns:
-            A service that is connected to the specified Google API.
+            A service that is connected to the specified Google API. It has its own
+            keep-alive connection so it must stay on one thread.
     """
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        key_file_location, scopes=scopes)
-    # Build the service object.
-    service = build(api_name, api_version, credentials=credentials)
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build,build_from_document
+    if credentials is None:
+        credentials = CredentialCache(scopes).get(key_file_location)
+    http = AuthorizedHttp(credentials,http=httplib2.Http(timeout=timeout))
+    if discoveryCacheDir is None:
+        # Build the service object.
+        return build(api_name, api_version, http=http)
+    documentPath = os.path.join(discoveryCacheDir,api_name + '.' + api_version + '.json')
+    try:
+        if documentPath not in discoveryDocuments:
+            with open(documentPath) as f:
+                discoveryDocuments[documentPath] = f.read()
+        return build_from_document(discoveryDocuments[documentPath],http=http)
+    except (IOError,ValueError):
+        #no saved document yet, or a damaged one
+        discoveryDocuments.pop(documentPath,None)
+    service = build(api_name, api_version, http=http, cache_discovery=False)
+    try:
+        if not os.path.isdir(discoveryCacheDir):
+            os.makedirs(discoveryCacheDir)
+        writeFileAtomically(documentPath,json.dumps(service._rootDesc))
+    except (IOError,OSError):
+        #the next run will just build it the slow way again
+        pass
     return service
 
 #GSpread Authentication setup
-def authorizeGSpread(pathToGSpreadConfigFile,scopes):
-    creds = ServiceAccountCredentials.from_json_keyfile_name(
-        pathToGSpreadConfigFile,SCOPES)
-    gs = gspread.authorize(creds)
+def authorizeGSpread(pathToGSpreadConfigFile,scopes,credentials=None,poolSize=10):
+    '''a gspread client on a pooled keep-alive session. Unlike the Drive client it can be
+    shared between threads, with up to poolSize connections open at once'''
+    import gspread
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    if credentials is None:
+        credentials = CredentialCache(scopes).get(pathToGSpreadConfigFile)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=1,pool_maxsize=poolSize)
+    session.mount('https://',adapter)
+    gs = gspread.authorize(credentials,session=session)
     return gs
 
+
+def makeSharedFactory(factory):
+    '''a factory that makes its client once, on first use, and gives every caller that one'''
+    made = []
+    lock = threading.Lock()
+    def sharedFactory():
+        with lock:
+            if not made:
+                made.append(factory())
+            return made[0]
+    return sharedFactory
+
+#######################Quota handling#####################################
+
+#HTTP statuses that are worth trying again after a pause
+RETRYABLE_STATUSES = (429,500,502,503,504)
+
+#gspread calls that count against the Sheets read quota, the rest count as writes
+SHEETS_READ_OPS = ('open_by_key','get_worksheet','worksheet','col_values','row_values',
+                   'get_all_records','get_all_values','get','batch_get','acell','cell',
+                   'values_get','values_batch_get','fetch_sheet_metadata')
+
+#calls that make something new each time they are sent. If one fails with a server error
+#or a dropped connection it may still have gone through, so it is not simply sent again
+NON_IDEMPOTENT_OPS = ('drive.files.create','drive.files.copy',
+                      'sheets.append_rows','sheets.append_row','sheets.values_append',
+                      'sheets.delete_rows')
+
+
+def getErrorStatus(error):
+    '''returns the HTTP status of a Drive (HttpError) or gspread (APIError) error, or None'''
+    response = getattr(error,'resp',None) or getattr(error,'response',None)
+    status = getattr(response,'status',None) or getattr(response,'status_code',None)
+    if status is None:
+        status = getattr(error,'status',None)
+    try:
+        return int(status)
+    except (TypeError,ValueError):
+        return None
+
+
+def isRateLimitError(error):
+    '''a 429 or a 403 rate limit - the request was turned away before anything was done'''
+    status = getErrorStatus(error)
+    return status == 429 or (status == 403 and ('rateLimitExceeded' in str(error) or
+                                                'RATE_LIMIT_EXCEEDED' in str(error)))
+
+
+def isRetryableError(error):
+    '''quota errors (429 or 403 rate limit), server errors and dropped connections are retryable'''
+    if isRateLimitError(error):
+        return True
+    if isinstance(error,ConnectionError):
+        return True
+    #requests is only loaded with gspread, and if it is not loaded it cannot have raised
+    requests = sys.modules.get('requests')
+    if requests is not None and isinstance(error,(requests.exceptions.ConnectionError,
+                                                  requests.exceptions.Timeout)):
+        return True
+    return getErrorStatus(error) in RETRYABLE_STATUSES
+
+
+def getPayloadSize(args,kwargs):
+    '''a rough size in bytes of what a call sends, good enough to compare calls'''
+    try:
+        return len(json.dumps([args,kwargs or {}],default=str))
+    except (TypeError,ValueError):
+        return 0
+
+
+def getBackoffDelay(attempt,baseDelay=1.0,maxDelay=64.0):
+    '''exponential backoff with full jitter - a random wait between 0 and base * 2^attempt seconds'''
+    return random.uniform(0,min(maxDelay,baseDelay * (2 ** attempt)))
+
+
+class TokenBucket(object):
+    '''a thread safe token bucket refilled at ratePerMinute and holding at most burst tokens.
+    acquire() blocks until the tokens are available and returns how long it waited.
+    A request for more tokens than the bucket holds (a big Drive batch) waits for a
+    full bucket and leaves it in debt'''
+
+    def __init__(self,ratePerMinute,burst=None):
+        self.ratePerSecond = ratePerMinute / 60.0
+        self.capacity = float(burst or max(1,ratePerMinute // 6))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self,tokens=1):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,self.tokens + (now - self.updated) * self.ratePerSecond)
+                self.updated = now
+                needed = min(tokens,self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return waited
+                sleepFor = (needed - self.tokens) / self.ratePerSecond
+            time.sleep(sleepFor)
+            waited += sleepFor
+
+
+class ApiGuard(object):
+    '''the one place every Drive and Sheets call goes through.
+    Each call first takes a token from the bucket for its quota (drive, sheets.read or
+    sheets.write) so we stay under the per-minute limits, and retryable errors are tried
+    again with exponential backoff and jitter up to maxRetries times.
+    counters keeps totals of calls, calls that had to wait for the limiter (throttled),
+    retries and calls that failed for good.
+    Every function in observers is called after each call with the operation name,
+    seconds taken (waits and retries included), payload size in bytes, number of
+    retries and the outcome ('ok' or 'error' and the HTTP status or error type)'''
+
+    def __init__(self,ratesPerMinute,maxRetries=5,baseDelay=1.0,maxDelay=64.0):
+        self.buckets = dict((quota,TokenBucket(rate)) for quota,rate in ratesPerMinute.items())
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.counters = {'calls' : 0,'throttled' : 0,'retried' : 0,'failed' : 0}
+        self.observers = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fromConfig(cls,config):
+        '''defaults are the published per user quotas, Sheets counts reads and writes separately'''
+        sheetsRate = config.getint('Quota','sheetsRequestsPerMinute',fallback=60)
+        return cls({'drive' : config.getint('Quota','driveRequestsPerMinute',fallback=1000),
+                    'sheets.read' : sheetsRate,
+                    'sheets.write' : sheetsRate},
+                   maxRetries=config.getint('Quota','maxRetries',fallback=5),
+                   baseDelay=config.getfloat('Quota','backoffBaseSeconds',fallback=1.0),
+                   maxDelay=config.getfloat('Quota','backoffMaxSeconds',fallback=64.0))
+
+    def count(self,counter,amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def call(self,quota,opName,fn,args=(),kwargs=None,cost=1,retry=True,payloadSize=None,recover=None):
+        '''runs fn(*args, **kwargs) under the limiter for quota. cost is the number of
+        quota units the call uses. Calls that are not safe to repeat as a whole
+        (Drive batches) pass retry=False.
+        A call in NON_IDEMPOTENT_OPS is only sent again straight away after a rate limit
+        error. After any other retryable error recover() is called to look for what the
+        failed attempt made: its result is returned if it finds it, and the call is sent
+        again if it returns None. Without recover the error is raised'''
+        started = time.perf_counter()
+        attempt = 0
+        outcome = 'ok'
+        try:
+            while True:
+                bucket = self.buckets.get(quota)
+                if bucket is not None and bucket.acquire(cost) > 0:
+                    self.count('throttled')
+                self.count('calls')
+                try:
+                    return fn(*args,**(kwargs or {}))
+                except Exception as e:
+                    retryable = retry and attempt < self.maxRetries and isRetryableError(e)
+                    if retryable and opName in NON_IDEMPOTENT_OPS and not isRateLimitError(e):
+                        #the call may have gone through before the error
+                        try:
+                            recovered = recover() if recover is not None else None
+                        except Exception:
+                            #could not look, so it cannot be sent again safely
+                            recovered,recover = None,None
+                        if recovered is not None:
+                            return recovered
+                        retryable = recover is not None
+                    if not retryable:
+                        self.count('failed')
+                        outcome = 'error ' + str(getErrorStatus(e) or type(e).__name__)
+                        raise
+                self.count('retried')
+                time.sleep(getBackoffDelay(attempt,self.baseDelay,self.maxDelay))
+                attempt += 1
+        finally:
+            if self.observers:
+                if payloadSize is None:
+                    payloadSize = getPayloadSize(args,kwargs)
+                for observer in self.observers:
+                    observer(opName,time.perf_counter() - started,payloadSize,attempt,outcome)
+
+    def snapshot(self):
+        '''a copy of the counters as they are now, to pass to summary later'''
+        with self.lock:
+            return dict(self.counters)
+
+    def summary(self,since=None):
+        '''the counters as a log line, counted from a snapshot if one is given'''
+        with self.lock:
+            counters = dict((counter,value - (since or {}).get(counter,0))
+                            for counter,value in self.counters.items())
+        return ('API Calls: ' + str(counters['calls']) +
+                ' Throttled: ' + str(counters['throttled']) +
+                ' Retried: ' + str(counters['retried']) +
+                ' Failed: ' + str(counters['failed']))
+
+
+class GuardedDriveService(object):
+    '''wraps a Drive service built by get_google_service so every request
+    it executes goes through an ApiGuard. It is used exactly like the service'''
+
+    def __init__(self,service,guard):
+        self.service = service
+        self.guard = guard
+
+    def files(self):
+        return _GuardedDriveResource(self.service.files(),self.guard,'drive.files')
+
+    def new_batch_http_request(self,callback=None):
+        return _GuardedDriveBatch(self.service.new_batch_http_request(callback=callback),self.guard)
+
+    def __getattr__(self,name):
+        return getattr(self.service,name)
+
+
+class _GuardedDriveResource(object):
+    def __init__(self,resource,guard,opPrefix):
+        self.resource = resource
+        self.guard = guard
+        self.opPrefix = opPrefix
+
+    def __getattr__(self,name):
+        method = getattr(self.resource,name)
+        def buildRequest(*args,**kwargs):
+            return _GuardedDriveRequest(method(*args,**kwargs),self.guard,self.opPrefix + '.' + name,
+                                        self,kwargs.get('body'))
+        return buildRequest
+
+
+class _GuardedDriveRequest(object):
+    '''a file create or copy that fails with a server error is only sent again once
+    findGDriveFile has not found the file it was making, by name and folder'''
+
+    def __init__(self,request,guard,opName,filesResource=None,body=None):
+        self.request = request
+        self.guard = guard
+        self.opName = opName
+        self.filesResource = filesResource
+        self.body = body or {}
+
+    def execute(self):
+        recover = None
+        if self.opName in NON_IDEMPOTENT_OPS and self.body.get('name') and self.body.get('parents'):
+            #allow for the clocks being a little apart
+            createdAfter = datetime.utcnow() - timedelta(seconds=60)
+            recover = lambda: findGDriveFile(self.filesResource,self.body['name'],
+                                             self.body['parents'][0],createdAfter)
+        return self.guard.call('drive',self.opName,self.request.execute,
+                               payloadSize=len(getattr(self.request,'body',None) or ''),
+                               recover=recover)
+
+
+class _GuardedDriveBatch(object):
+    '''a batch costs one quota unit per request in it. A failed batch is not repeated
+    as some of its requests may have gone through - failed items come back to the
+    callback and it is up to the caller to send those again'''
+
+    def __init__(self,batch,guard):
+        self.batch = batch
+        self.guard = guard
+        self.size = 0
+
+    def add(self,request,callback=None,request_id=None):
+        self.batch.add(getattr(request,'request',request),callback=callback,request_id=request_id)
+        self.size += 1
+
+    def execute(self):
+        return self.guard.call('drive','drive.batch',self.batch.execute,cost=self.size,retry=False)
+
+
+class GuardedGSpreadObject(object):
+    '''wraps a gspread client, spreadsheet or worksheet so every method call goes through
+    an ApiGuard. Spreadsheets and worksheets it hands back are wrapped too'''
+
+    def __init__(self,target,guard):
+        self.target = target
+        self.guard = guard
+
+    def __getattr__(self,name):
+        attr = getattr(self.target,name)
+        if not callable(attr):
+            return attr
+        quota = 'sheets.read' if name in SHEETS_READ_OPS else 'sheets.write'
+        def guardedCall(*args,**kwargs):
+            import gspread
+            result = self.guard.call(quota,'sheets.' + name,attr,args,kwargs)
+            if isinstance(result,(gspread.Spreadsheet,gspread.Worksheet)):
+                return GuardedGSpreadObject(result,self.guard)
+            return result
+        return guardedCall
+
+
+def getPercentile(sortedValues,percent):
+    #nearest rank percentile of an already sorted list
+    if not sortedValues:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(sortedValues)))
+    return sortedValues[max(rank,1) - 1]
+
+
+class RunMetrics(object):
+    '''records every Drive and Sheets call of a run (add record to an ApiGuard's observers)
+    against the stage the run was in, and produces the run summary: p50/p95 latency and
+    counts per operation, calls and seconds per stage and total run time.
+    startup holds the seconds spent before the first call could be made - loading the script
+    and making the clients - by phase.
+    The summary is written as JSON and as a Prometheus textfile for node_exporter'''
+
+    def __init__(self):
+        self.startedAt = datetime.now()
+        self.startup = {}
+        self.rejected = []
+        #the number of requests the run processed, set by runSarProcess
+        self.processed = 0
+        self.started = time.perf_counter()
+        self.finished = None
+        self.stage = 'startup'
+        self.stageStarted = self.started
+        self.stageSeconds = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def setStage(self,stage):
+        with self.lock:
+            now = time.perf_counter()
+            self.stageSeconds[self.stage] = self.stageSeconds.get(self.stage,0.0) + now - self.stageStarted
+            self.stage = stage
+            self.stageStarted = now
+
+    def record(self,opName,latency,payloadSize,retries,outcome):
+        with self.lock:
+            self.calls.append((self.stage,opName,latency,payloadSize,retries,outcome))
+
+    def reject(self,rowNo,missingFields,duplicateRefs=()):
+        '''notes a form row that was quarantined and what it was missing, or which of its
+        references another row has already'''
+        rejection = {'row' : rowNo,'missing' : list(missingFields)}
+        if duplicateRefs:
+            rejection['duplicates'] = list(duplicateRefs)
+        with self.lock:
+            self.rejected.append(rejection)
+
+    def finish(self):
+        self.setStage('finished')
+        self.finished = time.perf_counter()
+
+    def summary(self):
+        with self.lock:
+            calls = list(self.calls)
+            stageSeconds = dict(self.stageSeconds)
+            rejected = list(self.rejected)
+        operations = {}
+        stages = {}
+        for stage,opName,latency,payloadSize,retries,outcome in calls:
+            op = operations.setdefault(opName,{'count' : 0,'errors' : 0,'retries' : 0,
+                                               'payloadBytes' : 0,'latencies' : []})
+            op['count'] += 1
+            op['errors'] += outcome != 'ok'
+            op['retries'] += retries
+            op['payloadBytes'] += payloadSize
+            op['latencies'].append(latency)
+            stageCalls = stages.setdefault(stage,{'calls' : 0,'operations' : {}})
+            stageCalls['calls'] += 1
+            stageCalls['operations'][opName] = stageCalls['operations'].get(opName,0) + 1
+        for op in operations.values():
+            latencies = sorted(op.pop('latencies'))
+            op['p50Seconds'] = getPercentile(latencies,50)
+            op['p95Seconds'] = getPercentile(latencies,95)
+        for stage,seconds in stageSeconds.items():
+            stages.setdefault(stage,{'calls' : 0,'operations' : {}})['seconds'] = seconds
+        return {'startedAt' : self.startedAt.strftime('%Y-%m-%dT%H:%M:%S'),
+                'runSeconds' : (self.finished or time.perf_counter()) - self.started,
+                'startupSeconds' : dict(self.startup),
+                'rejected' : rejected,
+                'processed' : self.processed,
+                'totalCalls' : len(calls),
+                'operations' : operations,
+                'stages' : stages}
+
+    def writeJson(self,path,summary=None):
+        writeFileAtomically(path,json.dumps(summary or self.summary(),indent=2,sort_keys=True))
+
+    def writePrometheus(self,path,summary=None,slowRun=False):
+        summary = summary or self.summary()
+        lines = ['# HELP sar_run_duration_seconds Wall time of the last SAR run.',
+                 '# TYPE sar_run_duration_seconds gauge',
+                 'sar_run_duration_seconds ' + repr(summary['runSeconds']),
+                 '# HELP sar_run_slow 1 if the last SAR run was much slower per request than the last busy one.',
+                 '# TYPE sar_run_slow gauge',
+                 'sar_run_slow ' + ('1' if slowRun else '0'),
+                 '# HELP sar_startup_seconds Time the last SAR run spent loading and making its clients.',
+                 '# TYPE sar_startup_seconds gauge']
+        lines += ['sar_startup_seconds{phase="%s"} %r' % (phase,seconds)
+                  for phase,seconds in sorted(summary.get('startupSeconds',{}).items())]
+        lines += ['# HELP sar_rejected_records Form rows quarantined by the last SAR run.',
+                  '# TYPE sar_rejected_records gauge',
+                  'sar_rejected_records ' + str(len(summary.get('rejected',[])))]
+        lines += ['# HELP sar_api_call_latency_seconds Latency of Drive and Sheets calls in the last run.',
+                  '# TYPE sar_api_call_latency_seconds summary']
+        for opName,op in sorted(summary['operations'].items()):
+            lines.append('sar_api_call_latency_seconds{operation="%s",quantile="0.5"} %r' % (opName,op['p50Seconds']))
+            lines.append('sar_api_call_latency_seconds{operation="%s",quantile="0.95"} %r' % (opName,op['p95Seconds']))
+            lines.append('sar_api_call_latency_seconds_count{operation="%s"} %d' % (opName,op['count']))
+        lines += ['# HELP sar_api_call_errors Drive and Sheets calls that failed in the last run.',
+                  '# TYPE sar_api_call_errors gauge']
+        lines += ['sar_api_call_errors{operation="%s"} %d' % (opName,op['errors'])
+                  for opName,op in sorted(summary['operations'].items())]
+        lines += ['# HELP sar_api_call_retries Retries of Drive and Sheets calls in the last run.',
+                  '# TYPE sar_api_call_retries gauge']
+        lines += ['sar_api_call_retries{operation="%s"} %d' % (opName,op['retries'])
+                  for opName,op in sorted(summary['operations'].items())]
+        lines += ['# HELP sar_stage_calls Drive and Sheets calls made in each stage of the last run.',
+                  '# TYPE sar_stage_calls gauge']
+        lines += ['sar_stage_calls{stage="%s"} %d' % (stage,info['calls'])
+                  for stage,info in sorted(summary['stages'].items())]
+        lines += ['# HELP sar_stage_duration_seconds Time spent in each stage of the last run.',
+                  '# TYPE sar_stage_duration_seconds gauge']
+        lines += ['sar_stage_duration_seconds{stage="%s"} %r' % (stage,info.get('seconds',0.0))
+                  for stage,info in sorted(summary['stages'].items())]
+        writeFileAtomically(path,'\n'.join(lines) + '\n')
+
+
+def writeFileAtomically(path,text):
+    #write to a temporary file first so a crash never leaves half a file behind
+    tmpPath = path + '.tmp'
+    with open(tmpPath,'w') as f:
+        f.write(text)
+    os.replace(tmpPath,path)
+
+
+def exportRunMetrics(metrics,logger):
+    '''writes the run summary to the JSON and Prometheus files named in the [Metrics] section.
+    If the run took more than slowRunFactor times as long per processed request as the last
+    run that processed any it is logged and flagged in the Prometheus file.
+    Runs that processed nothing are not compared and do not become the baseline, as a
+    no-op run takes next to no time'''
+    metrics.finish()
+    summary = metrics.summary()
+    jsonPath = config.get('Metrics','jsonFile',
+                          fallback=os.path.join(os.path.expanduser('~'),'ConfigFiles','sar_metrics.json'))
+    slowRun = False
+    baseline = None
+    try:
+        with open(jsonPath) as f:
+            baseline = json.load(f).get('slowRunBaseline')
+    except (IOError,ValueError):
+        pass
+    if summary['processed']:
+        secondsPerRequest = summary['runSeconds'] / summary['processed']
+        if baseline:
+            baselinePerRequest = baseline['runSeconds'] / baseline['processed']
+            if secondsPerRequest > baselinePerRequest * config.getfloat('Metrics','slowRunFactor',fallback=2.0):
+                slowRun = True
+                logger.log('Slow Run: ' + '%.2f' % secondsPerRequest + 's per request against ' +
+                           '%.2f' % baselinePerRequest + 's last time')
+        baseline = {'runSeconds' : summary['runSeconds'],'processed' : summary['processed']}
+    summary['slowRunBaseline'] = baseline
+    metrics.writeJson(jsonPath,summary)
+    prometheusPath = config.get('Metrics','prometheusTextfile',fallback=None)
+    if prometheusPath:
+        metrics.writePrometheus(prometheusPath,summary,slowRun)
+    return summary
+
+
 def createGDriveSubFolder(gService,parentFolderId,subFolderName):
     #this code create a subfolder on google drive and takes
     #google service handle,
@@ -81,27 +623,169 @@ def createGDriveSubFolder(gService,parentFolderId,subFolderName):
     
     return newDir
 
-def copyAndRenameGDriveFile(gService,fileToCopyId,NewFileName):
+def quoteDriveQueryValue(value):
+    return "'" + value.replace('\\','\\\\').replace("'","\\'") + "'"
+
+
+def findGDriveFile(filesResource,fileName,parentFolderId,createdAfter):
+    '''looks for a file called fileName in a folder made since createdAfter (a UTC datetime),
+    to see whether a create or copy that failed went through after all. It takes the
+    files() resource of a Drive service and returns {'id' : file id} or None'''
+    query = ' and '.join(['trashed = false',
+                          'name = ' + quoteDriveQueryValue(fileName),
+                          quoteDriveQueryValue(parentFolderId) + ' in parents',
+                          "createdTime > '" + createdAfter.strftime('%Y-%m-%dT%H:%M:%S') + "'"])
+    files = filesResource.list(q=query,orderBy='createdTime',fields='files(id)').execute().get('files',[])
+    return {'id' : files[0]['id']} if files else None
+
+
+def createGDriveSubFolders(gService,folderRequests,retryRounds=3):
+    '''this code creates many subfolders on google drive using Drive batch HTTP requests
+    so a whole run's folders cost one round trip per DRIVE_BATCH_SIZE folders
+    it takes
+    google service handle
+    a list of (reference, parentFolderId, subFolderName) tuples
+    (optional) how many times to resend items that failed with a retryable error
+    as input
+    it returns two dictionaries keyed by reference, one with the new folder ids
+    and one with the error for any folder that could not be created'''
+    folderIds = {}
+    folderErrors = {}
+
+    def folderCreated(requestId,response,exception):
+        if exception is not None:
+            folderErrors[requestId] = exception
+        else:
+            folderIds[requestId] = response.get('id')
+
+    #a reference asked for twice only gets one folder. Form rows sharing a reference are
+    #quarantined before they get here, see getDuplicateReferences
+    uniqueRequests = []
+    seenReferences = set()
+    for folderRequest in folderRequests:
+        if folderRequest[0] not in seenReferences:
+            seenReferences.add(folderRequest[0])
+            uniqueRequests.append(folderRequest)
+
+    #items that fail with a quota or server error are sent again in a later batch. A server
+    #error can come after the folder was made, so those are looked for before being resent
+    createdAfter = datetime.utcnow() - timedelta(seconds=60)
+    pendingRequests = uniqueRequests
+    for attempt in range(retryRounds + 1):
+        for start in range(0,len(pendingRequests),DRIVE_BATCH_SIZE):
+            chunk = pendingRequests[start:start + DRIVE_BATCH_SIZE]
+            batch = gService.new_batch_http_request(callback=folderCreated)
+            for reference,parentFolderId,subFolderName in chunk:
+                fmeta = {
+                    'name' : subFolderName,
+                    'mimeType' : 'application/vnd.google-apps.folder',
+                    'parents' : [parentFolderId]
+                    }
+                batch.add(gService.files().create(body=fmeta,fields='id'),
+                          request_id=reference)
+            try:
+                batch.execute()
+            except Exception as e:
+                #the batch request itself failed. Some of its folders may have been made
+                #before the connection dropped, so every item without an answer is treated
+                #as failed with the batch's error and looked for like any other
+                for reference,parentFolderId,subFolderName in chunk:
+                    if reference not in folderIds and reference not in folderErrors:
+                        folderErrors[reference] = e
+
+        pendingRequests = [r for r in pendingRequests
+                           if r[0] in folderErrors and isRetryableError(folderErrors[r[0]])]
+        if not pendingRequests:
+            break
+        resendRequests = []
+        for reference,parentFolderId,subFolderName in pendingRequests:
+            if not isRateLimitError(folderErrors[reference]):
+                try:
+                    madeFolder = findGDriveFile(gService.files(),subFolderName,parentFolderId,createdAfter)
+                except Exception:
+                    #could not look, so it cannot be sent again safely
+                    continue
+                if madeFolder is not None:
+                    folderIds[reference] = madeFolder['id']
+                    del folderErrors[reference]
+                    continue
+            if attempt < retryRounds:
+                del folderErrors[reference]
+                resendRequests.append((reference,parentFolderId,subFolderName))
+        pendingRequests = resendRequests
+        if not pendingRequests:
+            break
+        time.sleep(getBackoffDelay(attempt))
+
+    return folderIds,folderErrors
+
+def copyAndRenameGDriveFile(gService,fileToCopyId,NewFileName,destinationFolderId=None):
     '''This folder makes a copy of the specified Google drive file
     and renames it in one go. The new copy will still reside in the
-    same location as the file that was copied
+    same location as the file that was copied unless a destination
+    folder is given, in which case the copy is created straight in that folder
     it takes
     google service handle
     id of the file to copy
     new file name of the copied file
+    (optional) id of the folder to put the copy in
     as input'''
     
     
     copied_file = {'name' : NewFileName}
+    if destinationFolderId is not None:
+        copied_file['parents'] = [destinationFolderId]
     newFile = gService.files().copy(
                          fileId=fileToCopyId,
-                         body=copied_file).execute()
+                         body=copied_file,
+                         fields='id').execute()
     
     #return just the file Id
     fileId = newFile.get('id')
     return fileId
 
 
+def exportGDriveSpreadsheet(gService,fileId,xlsxPath):
+    #this saves a Google spreadsheet as an .xlsx file at xlsxPath
+    content = gService.files().export(fileId=fileId,
+                                      mimeType=XLSX_MIME_TYPE).execute()
+    with open(xlsxPath,'wb') as f:
+        f.write(content)
+
+
+def uploadGDriveSpreadsheet(gService,xlsxPath,newFileName,destinationFolderId):
+    '''This uploads an .xlsx file straight into a folder and converts it to a
+    Google spreadsheet on the way, so a template filled in locally is one call.
+    It returns the new file's id'''
+    from googleapiclient.http import MediaFileUpload
+    fmeta = {
+        'name' : newFileName,
+        'mimeType' : SPREADSHEET_MIME_TYPE,
+        'parents' : [destinationFolderId]
+        }
+    media = MediaFileUpload(xlsxPath,mimetype=XLSX_MIME_TYPE,resumable=False)
+    newFile = gService.files().create(body=fmeta,
+                                      media_body=media,
+                                      fields='id').execute()
+    return newFile.get('id')
+
+
+def listGDriveFiles(gService,query,fields='id,name,mimeType,parents,createdTime'):
+    #this lists every file matching a Drive search query, a full page at a time,
+    #and returns them as a list of dictionaries with the given fields
+    files = []
+    pageToken = None
+    while True:
+        page = gService.files().list(q=query,
+                                     pageSize=DRIVE_LIST_PAGE_SIZE,
+                                     pageToken=pageToken,
+                                     fields='nextPageToken,files(' + fields + ')').execute()
+        files.extend(page.get('files',[]))
+        pageToken = page.get('nextPageToken')
+        if not pageToken:
+            return files
+
+
 def getTimeString():
     return datetime.strftime(datetime.now(),"%d/%m/%y %H:%M:%S")
 
@@ -116,55 +800,82 @@ def moveGDriveFile(gService,sourceFolderId,destinationFolderId,fileId):
     id of the destination folder
     id of the file to be moved'''
     
-    pfile = gService.files().get(fileId=fileId,
-                                 fields='parents').execute()
-    previous_parents = ",".join(pfile.get('parents'))
-
+    #we already know the current location so there is no need to look the parents up first
     file = gService.files().update(fileId=fileId,
                                     addParents=destinationFolderId,
-                                    removeParents=previous_parents,
+                                    removeParents=sourceFolderId,
                                     fields='id, parents').execute()
 
    
-def doFolderWork(service,subjectName,subjectEmail,subjectSarReference,sarAction):
-    '''this function encapsulates all the folder work described above'''
-
-     
+def getFolderWorkDetails(subjectSarReference,sarAction):
+    '''works out where the folder work for a reference goes.
+    It returns the parent folder id, the template id, the new folder name and
+    the new template file name for an 'Access' or 'Delete' action'''
     if (sarAction == 'Access'):
         sarFolderId = config['Folder Ids']['sarsParentFolderId']        
         sarTemplateId = config['Template Ids']['sarSpreadheetTemplateId']
-        
-        #constitute the new Folder name 
-        newFolderName = 'S' + str(subjectSarReference) + ' - Open'
-        #make the new template filename
-        newTemplateFileName = 'DSR Reference Number: ' + 'S' + str(subjectSarReference)
+        refPrefix = 'S'
         
     if (sarAction == 'Delete'):
         sarFolderId = config['Folder Ids']['deleteParentFolderId']  
         sarTemplateId = config['Template Ids']['deleteSpreadsheetTemplateId']
-        
-        #constitute the new Folder name 
-        newFolderName = 'D' + str(subjectSarReference) + ' - Open'
-        #make the new template filename
-        newTemplateFileName = 'DSR Reference Number: ' + 'D' + str(subjectSarReference)
-    
-    #create the sub folder and keep the folder handle
-    newFolderHandle = createGDriveSubFolder(service,sarFolderId,newFolderName)
+        refPrefix = 'D'
+
+    #constitute the new Folder name 
+    newFolderName = refPrefix + str(subjectSarReference) + ' - Open'
+    #make the new template filename
+    newTemplateFileName = 'DSR Reference Number: ' + refPrefix + str(subjectSarReference)
+
+    return sarFolderId,sarTemplateId,newFolderName,newTemplateFileName
+
+
+def getRequestReferences(item):
+    '''returns the folder work a form record needs as a list of (action, reference number, reference)
+    a request for both gets two entries, access first and then delete'''
+    references = []
+    if item['Action Required:'] in ('Access To Information','Both (Access and Deletion)'):
+        refNumber = item['If DSAR Please Enter Next S-Number:']
+        references.append(('Access',refNumber,'S' + str(refNumber)))
+    if item['Action Required:'] in ('Deletion (Deletion Of Information)','Both (Access and Deletion)'):
+        refNumber = item['If Deletion Please Enter Next D-Number:']
+        references.append(('Delete',refNumber,'D' + str(refNumber)))
+    return references
+
 
-    #get the new subfolder id
-    newFolderId = newFolderHandle.get('id')
+def doFolderWork(backend,subjectName,subjectEmail,subjectSarReference,sarAction,newFolderId=None):
+    '''this function encapsulates all the folder work described above
+    if the subfolder has already been made (see createGDriveSubFolders) pass its id in
+    and only the template copy is done here. The copy is made straight into the
+    subfolder so there is no separate move'''
+
+    sarFolderId,sarTemplateId,newFolderName,newTemplateFileName = getFolderWorkDetails(
+        subjectSarReference,sarAction)
     
-    #create and rename the new template file
-    templateCopyId = copyAndRenameGDriveFile(service,sarTemplateId,newTemplateFileName)
+    if newFolderId is None:
+        #create the sub folder and get the new subfolder id
+        newFolderId = backend.createFolder(sarFolderId,newFolderName)
     
-    #get the new file id
-    #newtemplateFileId = templateCopyHandle.get('id')
-
-    #move the new template file to the correct subfolder
-    moveGDriveFile(service,sarFolderId,newFolderId,templateCopyId)
+    #create and rename the new template file inside the new subfolder
+    templateCopyId = backend.copyFile(sarTemplateId,newTemplateFileName,newFolderId)
     
     return templateCopyId
 
+
+def doLocalTemplateWork(backend,templateCache,subjectSarReference,sarAction,newFolderId,headerCells):
+    '''the template work of doFolderWork and setTemplateFileHeader in one upload. The header
+    is filled in on a local copy of the template and the finished file is uploaded straight
+    into the new subfolder'''
+    sarFolderId,sarTemplateId,newFolderName,newTemplateFileName = getFolderWorkDetails(
+        subjectSarReference,sarAction)
+
+    fileHandle,renderedPath = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fileHandle)
+    try:
+        templateCache.render(sarTemplateId,headerCells,renderedPath)
+        return backend.uploadSpreadsheet(renderedPath,newTemplateFileName,newFolderId)
+    finally:
+        os.remove(renderedPath)
+
 def connectToWorkbookSheet(gsAuth,workbookId,sheetIndex):
     '''connect to spreadsheet by spreadsheet ID
     this function takes an authenthicated gspread handle,
@@ -175,40 +886,89 @@ def connectToWorkbookSheet(gsAuth,workbookId,sheetIndex):
     return activeWorkSheet
 
 
-def setTemplateFileHeader(gsAuth,templateSheetId,userFullname,userEmail,userTemplateRef,sarReceiveDate,sarDueDate,userIdConfirmed):
+def setTemplateFileHeader(backend,templateSheetId,userFullname,userEmail,userTemplateRef,sarReceiveDate,sarDueDate,userIdConfirmed):
     '''this function puts user information in the header of the user's template
-    it is hardcoded and if the template file is changed this code must be updated
+    the cell for each value comes from the [Header Info Locations] section of the config file
+    and if the template file is changed the config must be updated
     otherwise it will unintentionally overwrite other data in the spreadsheet
 
-    we need to connect to the spreadsheet
-    get the handle of the first sheet in the spreadsheet (it only has one)
-    then start a series of update calls'''
-
-    aS = connectToWorkbookSheet(gsAuth,templateSheetId,0)
-    
-    #update template reference value 
-    aS.update_acell(
-        config['Header Info Locations']['referenceValueCell'],userTemplateRef)
-    
-    #update user name in template sheet
-    aS.update_acell(
-        config['Header Info Locations']['nameValueCell'], userFullname)
-    
-    #update user email address
-    aS.update_acell(
-        config['Header Info Locations']['emailValueCell'], userEmail)
-        
-    #update Date Received Cell
-    aS.update_acell(
-        config['Header Info Locations']['datereceivedValueCell'], sarReceiveDate)
-    
-    #update Due Date Cell
-    aS.update_acell(
-        config['Header Info Locations']['datedueValueCell'], sarDueDate)
-    
-    #update whether user id has been confirmed (usually 'No')
-    aS.update_acell(
-        config['Header Info Locations']['identityconfirmedValueCell'], userIdConfirmed)
+    all the header cells are written to the first (only) sheet with one batch update call,
+    so the cost stays the same however many header fields the template gets'''
+
+    backend.writeCells(templateSheetId,
+                       getTemplateHeaderCells(userFullname,userEmail,userTemplateRef,
+                                              sarReceiveDate,sarDueDate,userIdConfirmed))
+
+
+def getTemplateHeaderCells(userFullname,userEmail,userTemplateRef,sarReceiveDate,sarDueDate,userIdConfirmed):
+    '''the header of a user's template as a list of (A1 cell, value)'''
+    #the config key of each header cell and the value that goes into it
+    headerValues = {
+        'referenceValueCell' : userTemplateRef,
+        'nameValueCell' : userFullname,
+        'emailValueCell' : userEmail,
+        'datereceivedValueCell' : sarReceiveDate,
+        'datedueValueCell' : sarDueDate,
+        'identityconfirmedValueCell' : userIdConfirmed #usually 'No'
+        }
+    return [(config['Header Info Locations'][cellKey],value)
+            for cellKey,value in headerValues.items()]
+
+
+class TemplateCache(object):
+    '''keeps an .xlsx copy of each template in cacheDir so a template can be filled in
+    locally (see doLocalTemplateWork). A template is downloaded again when its Drive
+    modifiedTime is not the one it was saved at. The modifiedTime is only checked the
+    first time a template is used, so make a new TemplateCache for every run'''
+
+    def __init__(self,backend,cacheDir):
+        self.backend = backend
+        self.cacheDir = cacheDir
+        self.templatePaths = {}
+        self.lock = threading.Lock()
+
+    def getTemplatePath(self,templateId):
+        with self.lock:
+            if templateId in self.templatePaths:
+                return self.templatePaths[templateId]
+            xlsxPath = os.path.join(self.cacheDir,templateId + '.xlsx')
+            infoPath = xlsxPath + '.json'
+            modifiedTime = self.backend.getModifiedTime(templateId)
+            try:
+                with open(infoPath) as f:
+                    cachedModifiedTime = json.load(f).get('modifiedTime')
+            except (IOError,ValueError):
+                cachedModifiedTime = None
+            if cachedModifiedTime != modifiedTime or not os.path.exists(xlsxPath):
+                if not os.path.isdir(self.cacheDir):
+                    os.makedirs(self.cacheDir)
+                self.backend.downloadTemplate(templateId,xlsxPath + '.tmp')
+                os.replace(xlsxPath + '.tmp',xlsxPath)
+                writeFileAtomically(infoPath,json.dumps({'modifiedTime' : modifiedTime}))
+            self.templatePaths[templateId] = xlsxPath
+            return xlsxPath
+
+    def render(self,templateId,headerCells,outputPath):
+        '''saves the template with the (A1 cell, value) header cells filled in to outputPath'''
+        import openpyxl
+        workBook = openpyxl.load_workbook(self.getTemplatePath(templateId))
+        sheet = workBook.worksheets[0]
+        for cell,value in headerCells:
+            sheet[cell] = toXlsxValue(value)
+            if isinstance(sheet[cell].value,datetime):
+                sheet[cell].number_format = 'dd/mm/yyyy'
+        workBook.save(outputPath)
+
+
+def toXlsxValue(value):
+    '''a header value as it should go into an .xlsx cell. Dates in dd/mm/yyyy go in as dates,
+    the same as Sheets does with a USER_ENTERED write'''
+    if isinstance(value,str):
+        try:
+            return datetime.strptime(value,'%d/%m/%Y')
+        except ValueError:
+            pass
+    return value
 
 
 def getNextFillRow(sheetHandle):
@@ -220,336 +980,2205 @@ def getNextFillRow(sheetHandle):
     return (len(sheetHandle.col_values(1)) + 1)
 
 
-def writeToLog(authSheetService,logSheetId,whatToWrite):
-    '''This function writes info to the bespoke log file which is a google sheet. This was done
+def getDriveModifiedTime(gService,fileId):
+    '''returns the modifiedTime Drive holds for a file. Any change to a sheet,
+    including a new form submission, moves it on'''
+    return gService.files().get(fileId=fileId,fields='modifiedTime').execute().get('modifiedTime')
+
+
+def loadWatermark(watermarkPath):
+    '''the watermark remembers how far the last run got through the DSAR form sheet:
+    lastProcessedRow - every row up to and including this one has been processed
+    modifiedTime - the sheet's Drive modifiedTime when that run read it
+    lastFullScan - when the whole sheet was last read'''
+    watermark = {'lastProcessedRow' : 1,'modifiedTime' : None,'lastFullScan' : None}
+    if os.path.exists(watermarkPath):
+        with open(watermarkPath) as f:
+            watermark.update(json.load(f))
+    return watermark
+
+
+def saveWatermark(watermarkPath,watermark):
+    writeFileAtomically(watermarkPath,json.dumps(watermark))
+
+
+def isFullScanDue(watermark,fullScanHours):
+    if not watermark.get('lastFullScan'):
+        return True
+    lastFullScan = datetime.strptime(watermark['lastFullScan'],'%Y-%m-%dT%H:%M:%S')
+    return datetime.now() - lastFullScan >= timedelta(hours=fullScanHours)
+
+
+def readFormRecords(sheetHandle,startRow):
+    '''reads the header and the form rows from startRow to the bottom of the sheet in one call.
+    It returns the rows as a list of dictionaries keyed by the header, the same as
+    get_all_records. Blank rows are left out and every record has its sheet row
+    number under _sheetRow'''
+    from gspread.utils import numericise_all
+    if startRow > sheetHandle.row_count:
+        return []
+    headerRange,rowRange = sheetHandle.batch_get(['1:1',str(startRow) + ':' + str(sheetHandle.row_count)])
+    header = headerRange[0]
+    records = []
+    for rowOffset,row in enumerate(rowRange):
+        if not any(str(value) != '' for value in row):
+            #blank row
+            continue
+        values = numericise_all(list(row) + [''] * (len(header) - len(row)))
+        rec = dict(zip(header,values))
+        #keep where the record came from so it can be written back to the right row
+        rec['_sheetRow'] = startRow + rowOffset
+        records.append(rec)
+    return records
+
+
+def writeRowBlock(sheetHandle,startRow,rows):
+    '''this function writes a block of rows to a worksheet in a single range update
+    starting at startRow in column 1. The sheet is grown first if the block would run
+    past the bottom of the grid, otherwise the Sheets API rejects the write'''
+    if not rows:
+        return
+    from gspread.utils import rowcol_to_a1
+    width = max(len(row) for row in rows)
+    #pad short rows so the block is rectangular
+    rows = [list(row) + [''] * (width - len(row)) for row in rows]
+    endRow = startRow + len(rows) - 1
+    if endRow > sheetHandle.row_count:
+        sheetHandle.add_rows(endRow - sheetHandle.row_count)
+    blockRange = rowcol_to_a1(startRow,1) + ':' + rowcol_to_a1(endRow,width)
+    sheetHandle.update(range_name=blockRange,values=rows,value_input_option='USER_ENTERED')
+
+
+class SheetLogger(object):
+    '''This class writes info to the bespoke log file which is a google sheet. This was done
     because there will not be access to the standard logs on AWS
-    It takes an authenticate qspread connector, the id of the log file and the what to write as input'''
-    #connect to the log file
-    logSheet = connectToWorkbookSheet(authSheetService,logSheetId,0)
-    #get the next row number to write to
-    nextRowNumber = getNextFillRow(logSheet)
-    #write to the first column - hence the '1'
-    logSheet.update_cell(str(nextRowNumber),'1',whatToWrite)
 
-
-def fillInputSheet(authService,SubjectDataList,inputSheetId,inputSheetName):
+    Lines are buffered in memory and written in one go when flush() is called, so a log line
+    no longer costs a connect, a full column read and a cell write. The worksheet handle and
+    the next free row are looked up once on the first flush and kept after that.
+    If mirrorPath is given every line is also appended to that local JSONL file as soon as it
+    is logged so nothing is lost if a flush to the sheet fails.
+    With append the lines are appended to the sheet instead, for when other workers write
+    to the same log sheet and the next free row cannot be kept between flushes'''
+
+    def __init__(self,backend,logSheetId,mirrorPath=None,append=False):
+        self.backend = backend
+        self.logSheetId = logSheetId
+        self.mirrorPath = mirrorPath
+        self.append = append
+        self.logSheet = None
+        self.nextRowNumber = None
+        self.pending = []
+        #worker threads log too
+        self.lock = threading.RLock()
+
+    def log(self,whatToWrite):
+        with self.lock:
+            self.pending.append(whatToWrite)
+            if self.mirrorPath:
+                with open(self.mirrorPath,'a') as mirror:
+                    mirror.write(json.dumps({'time' : getTimeString(),
+                                             'logSheetId' : self.logSheetId,
+                                             'line' : whatToWrite}) + '\n')
+
+    def flush(self):
+        '''write all buffered lines to the log sheet with one range update.
+        A failed flush keeps the lines buffered for the next attempt'''
+        with self.lock:
+            if not self.pending:
+                return
+            lines = list(self.pending)
+            try:
+                if self.logSheet is None:
+                    #connect to the log file and find the next row to write to - once per run.
+                    #Both are kept only once both have worked, so a failed lookup is tried again
+                    logSheet = self.backend.openWorksheet(self.logSheetId,0)
+                    nextRowNumber = None if self.append else getNextFillRow(logSheet)
+                    self.logSheet,self.nextRowNumber = logSheet,nextRowNumber
+                #write to the first column
+                if self.append:
+                    self.logSheet.append_rows([[line] for line in lines])
+                else:
+                    writeRowBlock(self.logSheet,self.nextRowNumber,[[line] for line in lines])
+                    self.nextRowNumber += len(lines)
+            except Exception as e:
+                sys.stderr.write('Could not flush ' + str(len(lines)) + ' log lines: ' + str(e) + '\n')
+                return
+            del self.pending[:len(lines)]
+
+
+def fillInputSheet(backend,newRows,inputSheetId,append=False):
     #this function fills out the input sheet for the cron code to process
-    
+    #the rows are built by buildInputRows and written with one range update
+    if not newRows:
+        return
+
     #connect to the input spreadsheet
-    hSheet = connectToWorkbookSheet(authService,inputSheetId,0)
-    
-    #start a loop through all the data
-    for item in SubjectDataList:
-        #get the next row to fill in the spreadsheet
-        nextRowNumber = getNextFillRow(hSheet)
-
-        #constitute the ref number
-        if (item['Action Required:'] == 'Access To Information'):
-            strRef = 'S' + str(item['If DSAR Please Enter Next S-Number:'])
-            
-        if (item['Action Required:'] == 'Deletion (Deletion Of Information)'):
-            strRef = 'D' + str(item['If Deletion Please Enter Next D-Number:'])
-            
-        #For deletions and access only fill the sheet as if we want access
-        if (item['Action Required:'] == 'Both (Access and Deletion)'):
-            strRef = 'S' + str(item['If DSAR Please Enter Next S-Number:'])
-        
-        #test for Formstack
-        if inputSheetName == 'FormStack':
-            hSheet.update_cell(str(nextRowNumber),'1', strRef)
-            hSheet.update_cell(str(nextRowNumber),'2',item['Enter DSR Email Address:'])
-            
-        #test for Temppen Sheet
-        #these 3 tables need the same info in the same cells
-        if inputSheetName in ('TempPen','Zuora','EventBrite'):
-            hSheet.update_cell(str(nextRowNumber),'1',item['Enter DSR Email Address:'])
-            hSheet.update_cell(str(nextRowNumber),'2', strRef)
-            
-        #test for BiqQuery and Datalake
-        if inputSheetName in ('BigQuery','DataLake', 'OneOff') and len(str(item['Enter Identity ID:'])) > 0:
-            hSheet.update_cell(str(nextRowNumber),'1',strRef)
-            hSheet.update_cell(str(nextRowNumber),'2', item['Enter Identity ID:'])
-            
-        #test for Braze. Braze input sheet takes 3 inputs
-        if inputSheetName == 'braze':
-            #write the ref. There will always be a ref in the input sheet
-            hSheet.update_cell(str(nextRowNumber),'1',strRef)
-            #check if there is an identity id - there may not be one
-            if len(str(item['Enter Identity ID:'])) > 0:
-                hSheet.update_cell(str(nextRowNumber),'2', item['Enter Identity ID:'])
-            # there will always be an email address - the subject emailed us the start the process
-            hSheet.update_cell(str(nextRowNumber),'3',item['Enter DSR Email Address:'])
-                
-        
+    hSheet = backend.openWorksheet(inputSheetId,0)
+
+    if append:
+        #other workers fill the same sheet, so the end of the table is found by
+        #Sheets in the same call that writes the rows
+        try:
+            hSheet.append_rows(newRows,value_input_option='USER_ENTERED')
+        except Exception as e:
+            #a server error can come after the rows went in, so look before sending them again
+            if isRateLimitError(e) or not isRetryableError(e):
+                raise
+            if not hasRowBlock(hSheet,newRows):
+                hSheet.append_rows(newRows,value_input_option='USER_ENTERED')
+        return
+
+    #get the next row to fill in the spreadsheet - once for the whole block
+    nextRowNumber = getNextFillRow(hSheet)
+    writeRowBlock(hSheet,nextRowNumber,newRows)
+
+
+def hasRowBlock(sheetHandle,rows):
+    '''whether the rows are in the sheet, one after another, as Sheets shows them'''
+    from gspread.utils import rowcol_to_a1
+    def shown(row):
+        cells = [str(value) for value in row]
+        while cells and cells[-1] == '':
+            cells.pop()
+        return cells
+    width = max(len(row) for row in rows)
+    sheetRows = [shown(row) for row in sheetHandle.batch_get(['A:' + rowcol_to_a1(1,width)[:-1]])[0]]
+    block = [shown(row) for row in rows]
+    return any(sheetRows[start:start + len(block)] == block
+               for start in range(len(sheetRows) - len(block) + 1))
+
+
+#the short names input sheet columns can be given by. Any other name is taken to be
+#a form sheet header. ref is the record's reference - for a request for both it is the
+#S reference, as the input sheets are filled as if we want access
+INPUT_COLUMN_TOKENS = {'email' : 'Enter DSR Email Address:',
+                       'identity' : 'Enter Identity ID:',
+                       'name' : 'Requester\'s Name:',
+                       'received' : 'Received Date:',
+                       'due' : 'Due Date:'}
+
+#the input sheets the cron jobs read from: the sheet name, the config key of its id in
+#[Input File Ids], its columns and the columns a record must have a value in to get a row
+DEFAULT_INPUT_ROUTES = [('TempPen','temppenInputSheetId',['email','ref'],[]),
+                        ('FormStack','formstackInputSheetId',['ref','email'],[]),
+                        ('Zuora','zuoraInputSheetId',['email','ref'],[]),
+                        ('EventBrite','eventbriteInputSheetId',['email','ref'],[]),
+                        ('BigQuery','bigqueryInputSheetId',['ref','identity'],['identity']),
+                        ('DataLake','datalakeInputSheetId',['ref','identity'],['identity']),
+                        ('OneOff','oneoffInputSheetId',['ref','identity'],['identity']),
+                        #braze always gets a row, with the identity cell left blank if there is none
+                        ('braze','brazeSheetId',['ref','identity','email'],[])]
+
+
+class InputRoute(object):
+    '''one input sheet and how a form record becomes a row in it'''
+
+    def __init__(self,name,sheetIdKey,columns,requires=()):
+        self.name = name
+        self.sheetIdKey = sheetIdKey
+        self.columns = list(columns)
+        self.requires = list(requires)
+
+
+def splitColumnTokens(text):
+    return [token.strip() for token in text.split(',') if token.strip()]
+
+
+def getInputRoutes(routeConfig):
+    '''the input sheet routes: DEFAULT_INPUT_ROUTES changed or added to by any
+    [Input Route <sheet name>] sections in the config. Such a section can have
+        sheetIdKey - the key of the sheet id in [Input File Ids]
+        columns - comma separated column names, e.g. ref, identity, email
+        requires - the columns that must have a value for a record to get a row
+        enabled - no to leave the sheet out
+    A new sheet needs at least columns'''
+    routes = [InputRoute(*route) for route in DEFAULT_INPUT_ROUTES]
+    for section in routeConfig.sections():
+        if not section.startswith('Input Route '):
+            continue
+        name = section[len('Input Route '):].strip()
+        routeSection = routeConfig[section]
+        existing = [route for route in routes if route.name == name]
+        if not routeSection.getboolean('enabled',fallback=True):
+            routes = [route for route in routes if route.name != name]
+            continue
+        if existing:
+            route = existing[0]
+        elif 'columns' not in routeSection:
+            raise ValueError('[' + section + '] needs columns')
+        else:
+            route = InputRoute(name,name[:1].lower() + name[1:] + 'InputSheetId',[])
+            routes.append(route)
+        route.sheetIdKey = routeSection.get('sheetIdKey',route.sheetIdKey)
+        if 'columns' in routeSection:
+            route.columns = splitColumnTokens(routeSection['columns'])
+        if 'requires' in routeSection:
+            route.requires = splitColumnTokens(routeSection['requires'])
+    return routes
+
+
+def buildInputRows(routes,recordsList):
+    '''builds the rows for every input sheet in one pass over the records. A value is
+    looked up once per record however many sheets it goes to. It returns a dictionary
+    of route name to a list of (record, row)'''
+    rowsByRoute = dict((route.name,[]) for route in routes)
+    for rec in recordsList:
+        references = getRequestReferences(rec)
+        if not references:
+            continue
+        values = {'ref' : references[0][2]}
+        def getValue(token):
+            if token not in values:
+                values[token] = rec.get(INPUT_COLUMN_TOKENS.get(token,token),'')
+            return values[token]
+        for route in routes:
+            if all(len(str(getValue(token))) > 0 for token in route.requires):
+                rowsByRoute[route.name].append((rec,[getValue(token) for token in route.columns]))
+    return rowsByRoute
+
+
+def fillAllInputSheets(backend,recordsList,parallel=False,maxWorkers=4,journal=None):
+    '''fill all the input files - collect ids from config file
+    the rows for all of them are built together first (see buildInputRows). The input
+    sheets are independent spreadsheets so with parallel=True they are filled on a pool
+    of maxWorkers threads
+
+    a failure on one sheet does not stop the others. It returns a list of
+    (sheet name, error) in route order where error is None if the sheet was filled.
+    With a journal a sheet only gets the records it has not had yet'''
+
+    routes = getInputRoutes(config)
+    rowsByRoute = buildInputRows(routes,recordsList)
+
+    def fillOne(route):
+        stage = 'input_filled:' + route.name
+        sheetRecords = recordsList
+        sheetRows = rowsByRoute[route.name]
+        if journal is not None:
+            sheetRecords = [rec for rec in recordsList if not journal.get(getRecordKey(rec),stage)]
+            sheetRows = [(rec,row) for rec,row in sheetRows if not journal.get(getRecordKey(rec),stage)]
+        try:
+            fillInputSheet(backend,[row for rec,row in sheetRows],config['Input File Ids'][route.sheetIdKey],
+                           append=config.getboolean('Scale Out','enabled',fallback=False))
+            if journal is not None:
+                for rec in sheetRecords:
+                    journal.record(getRecordKey(rec),stage)
+            return (route.name,None)
+        except Exception as e:
+            return (route.name,e)
+
+    if not parallel:
+        return [fillOne(route) for route in routes]
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        futures = [pool.submit(fillOne,route) for route in routes]
+        return [f.result() for f in futures]
+
+def processRequest(backend,logger,item,folderIds,templateCache=None,journal=None):
+    '''does the template copy and header work for one form record once its
+    subfolders exist. It returns a list of (reference, action, folder id, template file id)
+    for what was made, or None if a folder for the record could not be created.
+    With a templateCache the template is filled in locally and uploaded instead.
+    With a journal every step is recorded as it is done, and a step already in the
+    journal from an earlier run is not done again'''
+    #subject requested for both action. The code will do the folderwork
+    #and the set template header process twice
+    #one for access and one for delete
+    references = getRequestReferences(item)
+    if any(ref not in folderIds for sarAction,refNumber,ref in references):
+        return None
+
+    def journaled(ref,stage):
+        return journal.get(ref,stage) if journal is not None else None
+
+    def record(ref,stage,result=True):
+        if journal is not None:
+            journal.record(ref,stage,result)
+
+    templateFiles = []
+    for sarAction,refNumber,ref in references:
+        tFileId = journaled(ref,'template_copied')
+        if tFileId is None and templateCache is not None:
+            #fill the header in locally and upload the finished template in one call
+            logger.log('Rendering Summary Template For ' + ref)
+            tFileId = doLocalTemplateWork(backend,
+                                          templateCache,
+                                          refNumber,
+                                          sarAction,
+                                          folderIds[ref],
+                                          getTemplateHeaderCells(item['Requester\'s Name:'],
+                                                                 item['Enter DSR Email Address:'],
+                                                                 ref,
+                                                                 item['Received Date:'],
+                                                                 item['Due Date:'],
+                                                                 'No')) #default
+            record(ref,'template_copied',tFileId)
+            record(ref,'header_written')
+        elif tFileId is None:
+            logger.log('Creating Summary Template For ' + ref)
+            tFileId = doFolderWork(backend,
+                                   item['Requester\'s Name:'],
+                                   item['Enter DSR Email Address:'],
+                                   refNumber,
+                                   sarAction,
+                                   folderIds[ref]
+                                   )
+            record(ref,'template_copied',tFileId)
+
+        if not journaled(ref,'header_written'):
+            #set the template file headers
+            logger.log('Writing Header Info For ' + ref)
+            setTemplateFileHeader(backend,
+                              tFileId,
+                              item['Requester\'s Name:'],
+                              item['Enter DSR Email Address:'],
+                              ref,
+                              item['Received Date:'],    
+                              item['Due Date:'],
+                              'No') #default
+            record(ref,'header_written')
+        templateFiles.append((ref,sarAction,folderIds[ref],tFileId))
+    return templateFiles
+
+
+def processRequests(backend,logger,requestList,folderIds,parallel=False,maxWorkers=4,templateCache=None,journal=None):
+    '''runs processRequest over every record in requestList.
+    Requests do not depend on each other so with parallel=True they are worked on
+    by a pool of maxWorkers threads.
+
+    It yields (record, result, error) in the same order as requestList as soon as each
+    result is ready, so the caller can write back in order while later requests are
+    still being worked on'''
+
+    def processOne(item):
+        try:
+            return (item,processRequest(backend,logger,item,folderIds,templateCache,journal),None)
+        except Exception as e:
+            return (item,None,e)
+
+    if not parallel:
+        for item in requestList:
+            yield processOne(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        for result in pool.map(processOne,requestList):
+            yield result
+
+
+def createRequestFolders(backend,logger,requestList,journal):
+    '''creates the subfolders for every reference of the records in Drive batches and
+    returns their ids keyed by reference. Folders the journal has from a run that did
+    not finish are used again. A reference whose folder failed is left out'''
+    folderIds = {}
+    folderRequests = []
+    for item in requestList:
+        for sarAction,refNumber,ref in getRequestReferences(item):
+            if journal.get(ref,'folder_created') is not None:
+                #made by a run that did not finish
+                folderIds[ref] = journal.get(ref,'folder_created')
+                continue
+            sarFolderId,sarTemplateId,newFolderName,newTemplateFileName = getFolderWorkDetails(refNumber,sarAction)
+            folderRequests.append((ref,sarFolderId,newFolderName))
+
+    logger.log('Creating ' + str(len(folderRequests)) + ' Folders')
+    try:
+        createdFolderIds,folderErrors = backend.createFolders(folderRequests)
+    except Exception as e:
+        #the records are left for the next run, the same as when each folder fails
+        createdFolderIds,folderErrors = {},dict((ref,e) for ref,parentFolderId,folderName in folderRequests)
+    for ref,folderId in createdFolderIds.items():
+        journal.record(ref,'folder_created',folderId)
+    folderIds.update(createdFolderIds)
+    for ref in folderErrors:
+        logger.log('Failed To Create Folder For ' + ref + ': ' + str(folderErrors[ref]))
+    return folderIds
+
+
+def openTemplateCache(backend,cacheDir=None):
+    '''with renderLocally each template is filled in from a cached .xlsx copy and uploaded
+    in one call, instead of a Drive copy followed by a Sheets header write.
+    It returns None when renderLocally is off'''
+    if not config.getboolean('Templates','renderLocally',fallback=False):
+        return None
+    return TemplateCache(backend,cacheDir or config.get('Templates','cacheDir',
+                                                        fallback=os.path.join(os.path.expanduser('~'),'ConfigFiles','template_cache')))
+
+
+def getMissingFields(rec):
+    '''the form fields a record needs for its Action Required: but has no value in.
+    A record with an action we do not know is missing Action Required:'''
+    action = rec.get('Action Required:','')
+    neededFields = []
+    if action in ('Access To Information','Both (Access and Deletion)'):
+        neededFields.append('If DSAR Please Enter Next S-Number:')
+    if action in ('Deletion (Deletion Of Information)','Both (Access and Deletion)'):
+        neededFields.append('If Deletion Please Enter Next D-Number:')
+    if not neededFields:
+        return ['Action Required:']
+    return [field for field in neededFields if len(str(rec.get(field,''))) == 0]
+
+
+def getDuplicateReferences(rec,referenceRows,index):
+    '''the references of a form record that another form row already has - one waiting
+    before it (referenceRows maps those references to their rows) or one in the artifact
+    index. Two rows with the same S or D number would share one folder and template.
+    It returns (reference, the other row) pairs, the row is None if the index does not know it'''
+    duplicates = []
+    for sarAction,refNumber,ref in getRequestReferences(rec):
+        otherRow = referenceRows.get(ref)
+        if otherRow is None:
+            entry = index.lookup(ref)
+            if entry is None:
+                continue
+            otherRow = entry['form_row']
+        if otherRow != rec['_sheetRow']:
+            duplicates.append((ref,otherRow))
+    return duplicates
+
+
+def describeDuplicates(duplicates):
+    return ', '.join(ref + ' already used by ' + ('form row ' + str(otherRow) if otherRow is not None else 'an indexed request')
+                     for ref,otherRow in duplicates)
+
+
+def updateSpreadsheetRecord(sheetConn,rowStamps,processedColumn=3):
+    #this function updates the processed column in the form sheet
+    #it is column 3 for gSpread
+    #rowStamps is a list of (sheet row, text) and they all go in one batch update
+    if not rowStamps:
+        return
+    from gspread.utils import rowcol_to_a1
+    sheetConn.batch_update([{'range' : rowcol_to_a1(rowNo,processedColumn),
+                             'values' : [[text]]}
+                            for rowNo,text in rowStamps],
+                           value_input_option='USER_ENTERED')
+
+
+def getStampedRows(sheetConn,rowNumbers,processedColumn=3):
+    '''reads the processed column of the given rows in one call and returns the rows
+    that have been stamped'''
+    if not rowNumbers:
+        return set()
+    from gspread.utils import rowcol_to_a1
+    rowNumbers = sorted(rowNumbers)
+    cells = sheetConn.batch_get([rowcol_to_a1(rowNo,processedColumn) for rowNo in rowNumbers])
+    return set(rowNo for rowNo,cell in zip(rowNumbers,cells) if cell and cell[0] and str(cell[0][0]) != '')
+
+
+class ProcessedStamper(object):
+    '''collects the Processed stamps for a run and writes them with updateSpreadsheetRecord.
+    Each record carries the sheet row it was read from (see readFormRecords) so the
+    right row is stamped wherever it sits in the sheet.
+    With checkpointEvery set the stamps are written every that many records,
+    otherwise they all go in one write when commit() is called.
+    A record that fails validation is stamped Quarantined with the reason, the fields it is
+    missing or the references another row has already,
+    instead, so it is not picked up again until someone fixes it and clears the cell.
+    With a journal each processed record is marked stamped there once its stamp is written.
+    With leaseCheck (renewLeases for a backend) the rows are only stamped if this worker
+    still holds them. The others are kept in released, and their records are marked
+    released in the journal'''
+
+    def __init__(self,sheetConn,processedColumn=3,checkpointEvery=0,journal=None,leaseCheck=None):
+        self.sheetConn = sheetConn
+        self.processedColumn = processedColumn
+        self.checkpointEvery = checkpointEvery
+        self.journal = journal
+        self.leaseCheck = leaseCheck
+        self.pending = []
+        self.released = set()
+
+    def stamp(self,rec):
+        self.pending.append((rec['_sheetRow'],'Processed ' + getTimeString(),True))
+        if self.checkpointEvery and len(self.pending) >= self.checkpointEvery:
+            self.commit()
+
+    def quarantine(self,rec,reason):
+        self.pending.append((rec['_sheetRow'],'Quarantined ' + getTimeString() + ': ' + reason,False))
+
+    def commit(self):
+        if self.leaseCheck is not None and self.pending:
+            #a row another worker has taken over is its to stamp now
+            heldRows = self.leaseCheck([rowNo for rowNo,text,processed in self.pending])
+            for rowNo,text,processed in self.pending:
+                if rowNo not in heldRows:
+                    self.released.add(rowNo)
+                    if processed and self.journal is not None:
+                        self.journal.record(getRowKey(rowNo),'released')
+            self.pending = [stamp for stamp in self.pending if stamp[0] in heldRows]
+        #the stamps are only dropped once they have been written
+        updateSpreadsheetRecord(self.sheetConn,[(rowNo,text) for rowNo,text,processed in self.pending],
+                                self.processedColumn)
+        if self.journal is not None:
+            for rowNo,text,processed in self.pending:
+                if processed:
+                    self.journal.record(getRowKey(rowNo),'stamped')
+        self.pending = []
 
-        
-def fillAllInputSheets(gc,recordsList):
-    #fill input files - collect ids from config file
-    
-    temppenSheetId = config['Input File Ids']['temppenInputSheetId']
-    formstackSheetId = config['Input File Ids']['formstackInputSheetId']
-    zuoraInputSheetId = config['Input File Ids']['zuoraInputSheetId']
-    eventbriteInputSheetId = config['Input File Ids']['eventbriteInputSheetId']
-    bigQueryInputSheetId = config['Input File Ids']['bigqueryInputSheetId']
-    datalakeInputSheetId = config['Input File Ids']['datalakeInputSheetId']
-    brazeInputSheetId = config['Input File Ids']['brazeSheetId']
     
+           
 
-    fillInputSheet(gc,recordsList,temppenSheetId,'TempPen')
-    fillInputSheet(gc,recordsList,formstackSheetId,'FormStack')
-    fillInputSheet(gc,recordsList,zuoraInputSheetId,'Zuora')
-    fillInputSheet(gc,recordsList,eventbriteInputSheetId,'EventBrite')
-    fillInputSheet(gc,recordsList,bigQueryInputSheetId,'BigQuery')
-    fillInputSheet(gc,recordsList,datalakeInputSheetId,'DataLake')
-    fillInputSheet(gc,recordsList,oneoffInputSheetId,'OneOff')
-    fillInputSheet(gc,recordsList,brazeInputSheetId,'braze')
-
-def checkDataConsistency(recList):
-    if recList['Action Required:'] == 'Both (Access and Deletion)':
-        if len(str(recList['If Deletion Please Enter Next D-Number:'])) > 0 and len(str(recList['If DSAR Please Enter Next S-Number:'])) > 0:
-            return True
-    
-    if recList['Action Required:'] == 'Access To Information':
-        if  len(str(recList['If DSAR Please Enter Next S-Number:'])) > 0:
+#######################Artifact index#####################################
+
+def getReferenceFromName(name):
+    '''the S or D reference at the start of a folder name like S123 - Open, or None'''
+    match = re.match(r'([SD]\d+)\b',name)
+    return match.group(1) if match else None
+
+
+class ArtifactIndex(object):
+    '''a local SQLite index of what was made in Drive for every S and D reference: its
+    folder, its template file, when it was made and the form row it came from. Finding
+    these again otherwise takes a files.list name search over the big parent folders.
+
+    Every processed reference is recorded at the end of a run. rebuild() fills the
+    index again from Drive, for example on a new machine'''
+
+    COLUMNS = ('ref','action','folder_id','template_file_id','created_at','form_row')
+
+    def __init__(self,path):
+        import sqlite3
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.connection = sqlite3.connect(path,check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS artifacts (
+                                           ref TEXT PRIMARY KEY,
+                                           action TEXT NOT NULL,
+                                           folder_id TEXT,
+                                           template_file_id TEXT,
+                                           created_at TEXT,
+                                           form_row INTEGER)''')
+
+    def record(self,artifacts):
+        '''adds or replaces a list of (ref, action, folder id, template file id, form row),
+        all in one transaction. They are stamped with the current time'''
+        #UTC, the same as Drive's createdTime
+        createdAt = datetime.strftime(datetime.utcnow(),'%Y-%m-%dT%H:%M:%SZ')
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO artifacts VALUES (?,?,?,?,?,?)',
+                [(ref,action,folderId,templateFileId,createdAt,formRow)
+                 for ref,action,folderId,templateFileId,formRow in artifacts])
+
+    def lookup(self,ref):
+        '''the index entry for a reference as a dictionary, or None'''
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM artifacts WHERE ref = ?',(ref,)).fetchone()
+        return dict(row) if row else None
+
+    def list(self,action=None,since=None):
+        '''every entry, oldest first, optionally only one action ('Access' or 'Delete')
+        or the ones made since an ISO timestamp'''
+        query = 'SELECT * FROM artifacts WHERE 1 = 1'
+        params = []
+        if action:
+            query += ' AND action = ?'
+            params.append(action)
+        if since:
+            query += ' AND created_at >= ?'
+            params.append(since)
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY created_at,ref',params).fetchall()
+        return [dict(row) for row in rows]
+
+    def rebuild(self,backend):
+        '''replaces the index with what is in Drive: one paged listing of the folders in each
+        parent folder and one of all the template files. Form rows are kept for references
+        already in the index. It returns the number of references found'''
+        folders = {}
+        for action,parentKey in (('Access','sarsParentFolderId'),('Delete','deleteParentFolderId')):
+            for folder in backend.listFiles(parentFolderId=config['Folder Ids'][parentKey],
+                                            mimeType=FOLDER_MIME_TYPE):
+                ref = getReferenceFromName(folder['name'])
+                if ref is not None:
+                    #Drive gives milliseconds as well, the index keeps whole seconds
+                    createdTime = folder.get('createdTime')
+                    if createdTime:
+                        createdTime = createdTime[:19] + 'Z'
+                    folders[folder['id']] = (ref,action,createdTime)
+        templateIds = {}
+        for templateFile in backend.listFiles(nameContains='DSR Reference Number:',
+                                              mimeType=SPREADSHEET_MIME_TYPE):
+            for parentId in templateFile.get('parents',[]):
+                if parentId in folders:
+                    templateIds[parentId] = templateFile['id']
+
+        with self.lock, self.connection:
+            formRows = dict(self.connection.execute('SELECT ref,form_row FROM artifacts').fetchall())
+            self.connection.execute('DELETE FROM artifacts')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO artifacts VALUES (?,?,?,?,?,?)',
+                [(ref,action,folderId,templateIds.get(folderId),createdTime,formRows.get(ref))
+                 for folderId,(ref,action,createdTime) in folders.items()])
+        return len(folders)
+
+    def close(self):
+        self.connection.close()
+
+
+def openArtifactIndex():
+    '''the artifact index named in the config'''
+    return ArtifactIndex(config.get('State','indexFile',
+                                    fallback=os.path.join(os.path.expanduser('~'),'ConfigFiles','sar_index.sqlite')))
+
+
+#######################Stage journal#####################################
+
+def getRowKey(rowNo):
+    return 'row ' + str(rowNo)
+
+
+def getRecordKey(rec):
+    '''the journal key of a form record, from the sheet row it was read from'''
+    return getRowKey(rec['_sheetRow'])
+
+
+class StageJournal(object):
+    '''a write-ahead journal of the work done for each form record. A run that dies part
+    way through is picked up where it stopped by the next run, which does only the work
+    that is left instead of making duplicate folders and templates.
+
+    It is a JSONL file with a line for every stage as soon as it is done:
+        accepted - the record itself, once it has passed validation
+        folder_created, template_copied, header_written - for each reference
+        stamped, input_filled:<input sheet> - for the record
+        released - the record's lease went to another worker, see claimFormRows
+    compact() drops the lines of records that have been through every stage'''
+
+    def __init__(self,path):
+        self.path = path
+        self.stages = {}
+        self.inputSheetNames = [route.name for route in getInputRoutes(config)]
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        #the last line is cut short if a run died while writing it
+                        continue
+                    self.stages.setdefault(entry['key'],{})[entry['stage']] = entry['result']
+        elif os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    def get(self,key,stage):
+        '''what was recorded for a stage, or None if it has not been done'''
+        with self.lock:
+            return self.stages.get(key,{}).get(stage)
+
+    def record(self,key,stage,result=True):
+        entry = {'key' : key,'stage' : stage,'result' : result,'time' : getTimeString()}
+        with self.lock:
+            #the line is written out before anything else happens
+            with open(self.path,'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.stages.setdefault(key,{})[stage] = result
+
+    def accept(self,rec):
+        '''keeps a validated record, and its references, so it can be finished from here'''
+        if self.get(getRecordKey(rec),'accepted') is None:
+            self.record(getRecordKey(rec),'accepted',
+                        {'record' : rec,
+                         'refs' : [ref for sarAction,refNumber,ref in getRequestReferences(rec)]})
+
+    def isFinished(self,key):
+        stages = self.stages.get(key,{})
+        if 'released' in stages:
+            #another worker has the row now
             return True
-                   
-    if recList['Action Required:'] == 'Deletion (Deletion Of Information)':
-        if len(str(recList['If Deletion Please Enter Next D-Number:'])) > 0:
-            return True
-    return False                        
-
-def updateSpreadsheetRecord(sheetConn,totalRecords,numRecsToProcess,recIndex):
-    #this function updated the procesed column in the spreadsheet
-    #it is column 3 for gSpread
-    #we want to use the passed numbers to find the row number to write to
-    
-    rowNo = (totalRecords - numRecsToProcess + recIndex) + 1
-    sheetConn.update_cell(rowNo,3,'Processed '+ getTimeString())
+        return 'stamped' in stages and all('input_filled:' + sheetName in stages
+                                           for sheetName in self.inputSheetNames)
+
+    def unfinishedRecords(self):
+        '''the accepted records that have not been through every stage, in form order'''
+        with self.lock:
+            records = [stages['accepted']['record'] for key,stages in self.stages.items()
+                       if 'accepted' in stages and not self.isFinished(key)]
+        return sorted(records,key=lambda rec: rec['_sheetRow'])
+
+    def compact(self):
+        '''rewrites the journal without the records that are finished and their references'''
+        with self.lock:
+            finished = set()
+            for key,stages in self.stages.items():
+                if 'accepted' in stages and self.isFinished(key):
+                    finished.add(key)
+                    finished.update(stages['accepted']['refs'])
+            for key in finished:
+                del self.stages[key]
+            lines = [json.dumps({'key' : key,'stage' : stage,'result' : result,'time' : getTimeString()})
+                     for key,stages in self.stages.items() for stage,result in stages.items()]
+            writeFileAtomically(self.path,''.join(line + '\n' for line in lines))
+        return len(finished)
+
+
+def openStageJournal():
+    '''the stage journal named in the config'''
+    return StageJournal(config.get('State','journalFile',
+                                   fallback=os.path.join(os.path.expanduser('~'),'ConfigFiles','sar_journal.jsonl')))
+
+
+#######################Scale out#####################################
+
+#the claim log has a line for every claim: form row, worker id, claimed at and lease expiry,
+#both times in UTC
+CLAIM_LOG_HEADER = ['Form Row','Worker','Claimed At','Lease Until']
+CLAIM_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+#how many times a worker goes back for more rows when other workers won some of its claims
+CLAIM_ROUNDS = 3
+
+#the claim log's own row. Only the worker holding a lease on it prunes the log
+CLAIM_LOG_PRUNE_ROW = 0
+
+
+def getWorkerId():
+    return config.get('Scale Out','workerId',fallback=socket.gethostname())
+
+
+def getClaimLine(rowNo,workerId,now):
+    expiry = now + timedelta(seconds=config.getfloat('Scale Out','leaseSeconds',fallback=900))
+    return [rowNo,workerId,now.strftime(CLAIM_TIME_FORMAT),expiry.strftime(CLAIM_TIME_FORMAT)]
+
+
+def readClaimLog(claimSheet):
+    '''every line of the claim log as (form row, worker id, claimed at, lease expiry), in log
+    order. The header, and any line that cannot be read, is None'''
+    lines = []
+    for line in claimSheet.batch_get(['A:D'])[0]:
+        try:
+            lines.append((int(line[0]),line[1],datetime.strptime(line[2],CLAIM_TIME_FORMAT),
+                          datetime.strptime(line[3],CLAIM_TIME_FORMAT)))
+        except (IndexError,ValueError):
+            #the header
+            lines.append(None)
+    return lines
+
+
+def readClaimHolders(claimSheet,lines=None):
+    '''replays the claim log and returns who holds each form row, as
+    {form row : (worker id, lease expiry, worker it was taken over from or None)}.
+
+    A claim takes a row if nobody holds it, the holder's lease had run out when the claim
+    was made or the claim is the holder's own renewal. Any other claim lost to one before
+    it. The log is only appended to, apart from pruneClaimLog dropping lines that can no
+    longer matter, so every worker that replays it comes to the same answer whatever order
+    their claims were sent in'''
+    holders = {}
+    for line in (readClaimLog(claimSheet) if lines is None else lines):
+        if line is None:
+            continue
+        rowNo,workerId,claimedAt,expiry = line
+        holder = holders.get(rowNo)
+        if holder is None:
+            holders[rowNo] = (workerId,expiry,None)
+        elif holder[0] == workerId:
+            holders[rowNo] = (workerId,expiry,holder[2])
+        elif holder[1] <= claimedAt:
+            holders[rowNo] = (workerId,expiry,holder[0])
+    return holders
+
+
+def isClaimable(holder,workerId,now):
+    '''a row can be claimed if nobody holds it, its lease has run out or the lease is ours'''
+    return holder is None or holder[0] == workerId or holder[1] <= now
+
+
+def claimFormRows(backend,records,ownRecords=()):
+    '''with [Scale Out] enabled several workers, each with its own workerId, share one form
+    sheet. Before doing anything for a row a worker claims a lease on it in the claim log,
+    and only the rows it holds the lease on are its to process.
+
+    Up to claimBatchSize of the records that look free are claimed with one append to the
+    claim log, which is then read back and replayed (see readClaimHolders). Rows lost to
+    another worker are made up from the next free ones, for up to CLAIM_ROUNDS appends. A worker whose
+    claim reached the log after another worker's did has lost the row, however long its
+    append took. ownRecords - the rows this worker has unfinished in its journal - are
+    claimed first, so their leases are renewed. A lease left by a worker that died runs out
+    after leaseSeconds, when another worker picks the row up. leaseSeconds must be longer
+    than a run takes.
+    It returns the records this worker holds the lease on, in form order, and the holders
+    of every row in the log'''
+    claimSheet = backend.openWorksheet(config['Scale Out']['claimLogSheetId'],0)
+    workerId = getWorkerId()
+    claimBatchSize = config.getint('Scale Out','claimBatchSize',fallback=50)
+    ownRows = set(rec['_sheetRow'] for rec in ownRecords)
+    records = sorted(records,key=lambda rec: (rec['_sheetRow'] not in ownRows,rec['_sheetRow']))
+    holders = readClaimHolders(claimSheet)
+    claimedRows = set()
+    triedRows = set()
+    #workers starting together go for the same rows, so the rows lost to another worker
+    #are made up from the next free ones, for a few rounds
+    for claimRound in range(CLAIM_ROUNDS):
+        now = datetime.utcnow().replace(microsecond=0)
+        candidates = [rec for rec in records if rec['_sheetRow'] not in triedRows and
+                      isClaimable(holders.get(rec['_sheetRow']),workerId,now)]
+        candidates = candidates[:claimBatchSize - len(claimedRows)]
+        if not candidates:
+            break
+        claimSheet.append_rows([getClaimLine(rec['_sheetRow'],workerId,now) for rec in candidates])
+        holders = readClaimHolders(claimSheet)
+        for rec in candidates:
+            triedRows.add(rec['_sheetRow'])
+            if holders.get(rec['_sheetRow'],(None,))[0] == workerId:
+                claimedRows.add(rec['_sheetRow'])
+        if len(claimedRows) >= claimBatchSize:
+            break
+    return sorted((rec for rec in records if rec['_sheetRow'] in claimedRows),
+                  key=lambda rec: rec['_sheetRow']),holders
+
+
+def renewLeases(backend,rowNumbers):
+    '''claims rows this worker is working on again just before their stamps or input rows
+    are written. Nothing renews a lease while a run is working, and one held up by retries
+    can outlast leaseSeconds and lose its rows to another worker, which then processes them.
+    A renewal loses to any claim before it the same as a first claim does, so this is one
+    append and one read. It returns the rows this worker still holds'''
+    if not rowNumbers:
+        return set()
+    claimSheet = backend.openWorksheet(config['Scale Out']['claimLogSheetId'],0)
+    workerId = getWorkerId()
+    now = datetime.utcnow().replace(microsecond=0)
+    claimSheet.append_rows([getClaimLine(rowNo,workerId,now) for rowNo in sorted(set(rowNumbers))])
+    holders = readClaimHolders(claimSheet)
+    return set(rowNo for rowNo in rowNumbers if holders.get(rowNo,(None,))[0] == workerId)
+
+
+def getPrunableLineCount(lines,lastStampedRow,now):
+    '''how many lines after the header, from the top, are for rows up to lastStampedRow,
+    which are all stamped, with leases that have run out'''
+    count = 0
+    for line in lines[1:]:
+        if line is None or line[0] > lastStampedRow or line[3] > now:
+            break
+        count += 1
+    return count
+
+
+def pruneClaimLog(backend,lastStampedRow):
+    '''the claim log is only appended to, so every worker's replay would read more each run.
+    Once claimLogPruneLines lines at the top of the log are for stamped rows whose leases have
+    run out they are deleted: nobody claims a stamped row, and a claim on a row beats a lease
+    that has run out whether its lines are there or not.
+    Lines can only be deleted by where they are, so only one worker prunes at a time - the
+    one holding a lease on CLAIM_LOG_PRUNE_ROW - and it counts the lines again once it holds it.
+    It returns the number of lines deleted'''
+    claimSheet = backend.openWorksheet(config['Scale Out']['claimLogSheetId'],0)
+    now = datetime.utcnow().replace(microsecond=0)
+    pruneLines = config.getint('Scale Out','claimLogPruneLines',fallback=200)
+    if getPrunableLineCount(readClaimLog(claimSheet),lastStampedRow,now) < pruneLines:
+        return 0
+    workerId = getWorkerId()
+    claimSheet.append_rows([getClaimLine(CLAIM_LOG_PRUNE_ROW,workerId,now)])
+    lines = readClaimLog(claimSheet)
+    if readClaimHolders(claimSheet,lines).get(CLAIM_LOG_PRUNE_ROW,(None,))[0] != workerId:
+        #another worker is pruning
+        return 0
+    prunable = getPrunableLineCount(lines,lastStampedRow,now)
+    if prunable:
+        #a delete that failed part way is not sent again, as it may have gone through
+        claimSheet.delete_rows(2,prunable + 1)
+    return prunable
+
+
+def adoptAbandonedWork(backend,journal,records):
+    '''a worker that died holding a row may have made the row's folders and templates
+    before it went. When another worker takes the row over they are looked for in Drive by
+    name and put in its journal, so they are used rather than made a second time.
+    A template found this way has its header written again'''
+    for rec in records:
+        if getMissingFields(rec):
+            continue
+        for sarAction,refNumber,ref in getRequestReferences(rec):
+            if journal.get(ref,'folder_created') is not None:
+                continue
+            parentFolderId,templateId,folderName,templateName = getFolderWorkDetails(refNumber,sarAction)
+            folders = [f for f in backend.listFiles(parentFolderId,folderName,FOLDER_MIME_TYPE) if f['name'] == folderName]
+            if not folders:
+                continue
+            folderId = min(folders,key=lambda f: f['createdTime'])['id']
+            journal.record(ref,'folder_created',folderId)
+            templates = [f for f in backend.listFiles(folderId,templateName) if f['name'] == templateName]
+            if templates:
+                journal.record(ref,'template_copied',min(templates,key=lambda f: f['createdTime'])['id'])
+
+
+#######################Backfill#####################################
+
+def iterExportRows(exportPath):
+    '''the rows of a .csv file, or of the first sheet of an .xlsx file, one at a time'''
+    if os.path.splitext(exportPath)[1].lower() == '.csv':
+        import csv
+        with open(exportPath,newline='') as f:
+            for row in csv.reader(f):
+                yield row
+        return
+    import openpyxl
+    workBook = openpyxl.load_workbook(exportPath,read_only=True,data_only=True)
+    try:
+        for row in workBook.worksheets[0].iter_rows(values_only=True):
+            yield [formatXlsxValue(v) for v in row]
+    finally:
+        workBook.close()
+
+
+def iterBackfillRecords(exportPath):
+    '''streams the records of an export laid out like the DSAR form sheet, keyed by its header
+    row the same as readFormRecords. Blank rows are left out and _sheetRow is the row
+    number in the file'''
+    from gspread.utils import numericise_all
+    rows = iterExportRows(exportPath)
+    header = [str(name) for name in next(rows,[])]
+    for rowNo,row in enumerate(rows,2):
+        if not any(str(value) != '' for value in row):
+            #blank row
+            continue
+        values = numericise_all(list(row[:len(header)]) + [''] * (len(header) - len(row)))
+        rec = dict(zip(header,values))
+        rec['_sheetRow'] = rowNo
+        yield rec
+
+
+def formatBackfillCounts(counts):
+    return ', '.join(key + ' ' + str(counts[key]) for key in ('read','imported','skipped','rejected','failed'))
+
+
+def getBackfillJournalPath(exportPath):
+    #the journal is kept next to the export so rerunning the same file resumes it
+    return exportPath + '.journal.jsonl'
+
+
+def runBackfill(backend,logger,exportPath,journal,index,chunkSize=DRIVE_BATCH_SIZE,maxWorkers=4,
+                fillInputSheets=True,templateCache=None,progress=None):
+    '''imports historical requests from an .xlsx or .csv export of the DSAR form sheet.
+    The file is read chunkSize records at a time and each chunk goes through the same
+    validation, folder, template and input sheet work as a run of the form sheet: its
+    folders are made in Drive batches, its templates on a pool of maxWorkers threads and
+    each input sheet gets one write. Nothing is stamped as there is no form row.
+
+    Rows missing a reference are rejected and rows whose references are all in the
+    artifact index already are skipped, so a file can be loaded again safely. Every stage
+    goes in the journal so a backfill that dies is resumed by running it again.
+    progress is called with the running counts after every chunk, which are returned'''
+    counts = {'read' : 0,'imported' : 0,'skipped' : 0,'rejected' : 0,'failed' : 0}
+    logger.log(getTimeString() + '  Backfill Started From ' + os.path.basename(exportPath))
+    logger.flush()
+    records = iterBackfillRecords(exportPath)
+    while True:
+        chunk = list(itertools.islice(records,chunkSize))
+        if not chunk:
+            break
+        counts['read'] += len(chunk)
+
+        validList = []
+        for rec in chunk:
+            missingFields = getMissingFields(rec)
+            refs = [ref for sarAction,refNumber,ref in getRequestReferences(rec)]
+            if missingFields:
+                logger.log('Rejected Backfill Row ' + str(rec['_sheetRow']) + ': missing ' + ', '.join(missingFields))
+                counts['rejected'] += 1
+            elif journal.get(getRecordKey(rec),'accepted') is None and all(index.lookup(ref) is not None for ref in refs):
+                #made already, from the form sheet or an earlier backfill
+                counts['skipped'] += 1
+            else:
+                journal.accept(rec)
+                validList.append(rec)
+
+        folderIds = createRequestFolders(backend,logger,validList,journal)
+        processedList = []
+        artifacts = []
+        for item,templateFiles,requestError in processRequests(backend,logger,validList,folderIds,
+                                                               parallel=maxWorkers > 1,maxWorkers=maxWorkers,
+                                                               templateCache=templateCache,journal=journal):
+            if requestError is not None:
+                logger.log('Failed To Process Backfill Row ' + str(item['_sheetRow']) + ' (' +
+                           ', '.join(ref for sarAction,refNumber,ref in getRequestReferences(item)) + '): ' +
+                           str(requestError))
+            if templateFiles is None:
+                counts['failed'] += 1
+                continue
+            #there is no form row to stamp but the journal needs the stage to finish the record
+            journal.record(getRecordKey(item),'stamped','backfill')
+            processedList.append(item)
+            artifacts.extend((ref,sarAction,folderId,tFileId,None) for ref,sarAction,folderId,tFileId in templateFiles)
+        index.record(artifacts)
+
+        if fillInputSheets:
+            inputSheetResults = fillAllInputSheets(backend,processedList,parallel=maxWorkers > 1,
+                                                   maxWorkers=maxWorkers,journal=journal)
+            for sheetName,sheetError in inputSheetResults:
+                if sheetError is not None:
+                    logger.log('Failed To Fill Input Sheet ' + sheetName + ': ' + str(sheetError))
+        else:
+            for rec in processedList:
+                for sheetName in journal.inputSheetNames:
+                    journal.record(getRecordKey(rec),'input_filled:' + sheetName,'skipped')
+        counts['imported'] += len(processedList)
+        logger.flush()
+        if progress is not None:
+            progress(counts)
+
+    journal.compact()
+    logger.log(getTimeString() + '  Backfill Ended: ' + formatBackfillCounts(counts))
+    logger.log('******************') #separator
+    logger.flush()
+    return counts
+
+
+def planBackfill(exportPath,journalPath,chunkSize=DRIVE_BATCH_SIZE,maxWorkers=4,fillInputSheets=True,progress=None):
+    '''a dry run of runBackfill. It runs against a MemoryBackend made from the config, with
+    copies of the journal and artifact index, so nothing in Google or on disk is changed.
+    It returns the counts and the API round trips a real backfill would make by operation.
+    A Drive batch counts as one round trip however many folders are in it'''
+    planDir = tempfile.mkdtemp()
+    try:
+        roundTrips = {}
+        def countCall(opName,latency,payloadSize,retries,outcome):
+            roundTrips[opName] = roundTrips.get(opName,0) + 1
+        #a guard with no rate limits, only there to see every call
+        guard = ApiGuard({})
+        guard.observers.append(countCall)
+        backend = MemoryBackend.fromConfig(config,guard=guard)
+        logger = SheetLogger(backend,config['LogFiles ID']['sarAutomationMaster'])
+
+        planJournalPath = os.path.join(planDir,'journal.jsonl')
+        if os.path.exists(journalPath):
+            shutil.copyfile(journalPath,planJournalPath)
+        planIndexPath = os.path.join(planDir,'index.sqlite')
+        indexPath = config.get('State','indexFile',fallback=os.path.join(os.path.expanduser('~'),'ConfigFiles','sar_index.sqlite'))
+        if os.path.exists(indexPath):
+            shutil.copyfile(indexPath,planIndexPath)
+        index = ArtifactIndex(planIndexPath)
+        try:
+            counts = runBackfill(backend,logger,exportPath,StageJournal(planJournalPath),index,chunkSize,
+                                 maxWorkers,fillInputSheets,openTemplateCache(backend,os.path.join(planDir,'templates')),
+                                 progress)
+        finally:
+            index.close()
+        return counts,roundTrips
+    finally:
+        shutil.rmtree(planDir,ignore_errors=True)
+
+
+#######################Storage backends#####################################
+
+#the columns of the DSAR form sheet, as laid out in the bundled DSARInputFromForm file
+DSAR_FORM_HEADER = ['Timestamp','Email address','Processed?','Enter DSR Email Address:',
+                    'Requester\'s Name:','Action Required:','If DSAR Please Enter Next S-Number:',
+                    'If Deletion Please Enter Next D-Number:','Notes:',
+                    'Please Enter The Data Privacy Access Code:','Received Date:',
+                    'Enter Identity ID:','Due Date:']
+
+
+class StorageBackend(object):
+    '''the Drive and Sheets operations the script needs. GoogleBackend does them against
+    the real APIs and MemoryBackend keeps everything in memory, so the script can be run
+    and measured without Google credentials.
+
+    openWorksheet hands back a worksheet supporting the part of the gspread Worksheet
+    interface the script uses: row_count, col_values, batch_get, update, batch_update,
+    append_rows and add_rows.
+    A backend can be used from several threads at once'''
+
+    guard = None
+
+    def createFolder(self,parentFolderId,folderName):
+        '''creates a folder and returns its id'''
+        raise NotImplementedError
+
+    def createFolders(self,folderRequests):
+        '''creates a folder for each (reference, parentFolderId, folderName) and returns
+        (folder ids, errors), both keyed by reference'''
+        folderIds = {}
+        folderErrors = {}
+        for reference,parentFolderId,folderName in folderRequests:
+            if reference in folderIds:
+                continue
+            try:
+                folderIds[reference] = self.createFolder(parentFolderId,folderName)
+            except Exception as e:
+                folderErrors[reference] = e
+        return folderIds,folderErrors
+
+    def copyFile(self,fileId,newName,parentFolderId=None):
+        '''copies a file under a new name, into parentFolderId if given, and returns the copy's id'''
+        raise NotImplementedError
+
+    def moveFile(self,fileId,sourceFolderId,destinationFolderId):
+        raise NotImplementedError
+
+    def getModifiedTime(self,fileId):
+        raise NotImplementedError
+
+    def openWorksheet(self,spreadsheetId,sheetIndex=0):
+        raise NotImplementedError
+
+    def writeCells(self,spreadsheetId,cellValues):
+        '''writes a list of (A1 cell, value) to the first sheet of a spreadsheet in one call'''
+        raise NotImplementedError
+
+    def downloadTemplate(self,fileId,xlsxPath):
+        '''saves a spreadsheet as an .xlsx file at xlsxPath'''
+        raise NotImplementedError
+
+    def uploadSpreadsheet(self,xlsxPath,newName,parentFolderId):
+        '''uploads an .xlsx file into parentFolderId as a spreadsheet and returns its id'''
+        raise NotImplementedError
+
+    def listFiles(self,parentFolderId=None,nameContains=None,mimeType=None):
+        '''every file that is not in the bin and matches all the filters given, as dictionaries
+        with id, name, mimeType, parents and createdTime'''
+        raise NotImplementedError
+
+
+class GoogleBackend(StorageBackend):
+    '''Drive through googleapiclient and Sheets through gspread.
+    The Drive client cannot be shared between threads, so every Drive call checks one out of a
+    pool of idle clients and puts it back when it is done. driveFactory makes a new one only
+    when they are all in use, and the clients and their open connections are kept for as
+    long as the backend, through every thread pool and every daemon run.
+    sheetsFactory is called once on every thread and can hand back one shared client.
+    With a guard every call goes through its rate limiter and retries.
+    clientSeconds adds up the time spent making clients'''
+
+    def __init__(self,driveFactory,sheetsFactory,guard=None):
+        self.driveFactory = driveFactory
+        self.sheetsFactory = sheetsFactory
+        self.guard = guard
+        self.threadClients = threading.local()
+        self.idleDriveClients = []
+        self.driveLock = threading.Lock()
+        self.clientSeconds = 0.0
+
+    def makeClient(self,factory):
+        started = time.perf_counter()
+        client = factory()
+        self.clientSeconds += time.perf_counter() - started
+        return client
+
+    def withDrive(self,fn,*args):
+        '''runs fn with a Drive client from the pool as its first argument'''
+        with self.driveLock:
+            drive = self.idleDriveClients.pop() if self.idleDriveClients else None
+        if drive is None:
+            drive = self.makeClient(self.driveFactory)
+            if self.guard:
+                drive = GuardedDriveService(drive,self.guard)
+        try:
+            return fn(drive,*args)
+        finally:
+            with self.driveLock:
+                self.idleDriveClients.append(drive)
+
+    @property
+    def sheets(self):
+        if not hasattr(self.threadClients,'sheets'):
+            sheets = self.makeClient(self.sheetsFactory)
+            self.threadClients.sheets = GuardedGSpreadObject(sheets,self.guard) if self.guard else sheets
+        return self.threadClients.sheets
+
+    def createFolder(self,parentFolderId,folderName):
+        return self.withDrive(createGDriveSubFolder,parentFolderId,folderName).get('id')
+
+    def createFolders(self,folderRequests):
+        return self.withDrive(createGDriveSubFolders,folderRequests)
+
+    def copyFile(self,fileId,newName,parentFolderId=None):
+        return self.withDrive(copyAndRenameGDriveFile,fileId,newName,parentFolderId)
+
+    def moveFile(self,fileId,sourceFolderId,destinationFolderId):
+        self.withDrive(moveGDriveFile,sourceFolderId,destinationFolderId,fileId)
+
+    def getModifiedTime(self,fileId):
+        return self.withDrive(getDriveModifiedTime,fileId)
+
+    def openWorksheet(self,spreadsheetId,sheetIndex=0):
+        return connectToWorkbookSheet(self.sheets,spreadsheetId,sheetIndex)
+
+    def writeCells(self,spreadsheetId,cellValues):
+        #the values endpoint only needs the spreadsheet id, so the spreadsheet is not opened
+        #first and the write is one round trip. Ranges without a sheet name go to the first sheet
+        httpClient = self.sheets.http_client
+        if self.guard is not None:
+            httpClient = GuardedGSpreadObject(httpClient,self.guard)
+        httpClient.values_batch_update(
+            spreadsheetId,
+            body={'valueInputOption' : 'USER_ENTERED',
+                  'data' : [{'range' : cell,'values' : [[value]]} for cell,value in cellValues]})
+
+    def downloadTemplate(self,fileId,xlsxPath):
+        self.withDrive(exportGDriveSpreadsheet,fileId,xlsxPath)
+
+    def uploadSpreadsheet(self,xlsxPath,newName,parentFolderId):
+        return self.withDrive(uploadGDriveSpreadsheet,xlsxPath,newName,parentFolderId)
+
+    def listFiles(self,parentFolderId=None,nameContains=None,mimeType=None):
+        query = ['trashed = false']
+        if parentFolderId:
+            query.append(quoteDriveQueryValue(parentFolderId) + ' in parents')
+        if nameContains:
+            query.append('name contains ' + quoteDriveQueryValue(nameContains))
+        if mimeType:
+            query.append('mimeType = ' + quoteDriveQueryValue(mimeType))
+        return self.withDrive(listGDriveFiles,' and '.join(query))
+
+
+class SimulatedApiError(Exception):
+    '''raised by MemoryBackend in place of a Drive or Sheets HTTP error. It has a status
+    like the real errors so isRetryableError treats it the same way'''
+
+    def __init__(self,status,message):
+        Exception.__init__(self,str(status) + ' ' + message)
+        self.status = status
+
+
+def parseA1Range(rangeName):
+    '''turns an A1 range such as B2, A1:C5, 3:10, A5:M or 'Sheet 1'!A:A into
+    (first row, first column, last row, last column). Open ends come back as None'''
+    corners = []
+    for part in rangeName.split('!')[-1].split(':'):
+        letters,digits = re.match(r'^([A-Za-z]*)(\d*)$',part).groups()
+        col = 0
+        for letter in letters.upper():
+            col = col * 26 + ord(letter) - 64
+        corners.append((int(digits) if digits else None,col or None))
+    if len(corners) == 1:
+        corners.append(corners[0])
+    (firstRow,firstCol),(lastRow,lastCol) = corners
+    return firstRow,firstCol,lastRow,lastCol
+
+
+class MemoryWorksheet(object):
+    '''one sheet of a MemoryBackend spreadsheet. Values are held as a list of rows and
+    read back as strings the way the Sheets API returns formatted values.
+    Like the real API a write past the bottom of the grid is refused'''
+
+    def __init__(self,backend,fileId,rows=None,rowCount=1000,colCount=26):
+        self.backend = backend
+        self.fileId = fileId
+        self.rows = [list(row) for row in (rows or [])]
+        self.row_count = max(rowCount,len(self.rows))
+        self.col_count = max([colCount] + [len(row) for row in self.rows])
+
+    def readRange(self,rangeName):
+        firstRow,firstCol,lastRow,lastCol = parseA1Range(rangeName)
+        firstRow = firstRow or 1
+        firstCol = firstCol or 1
+        lastRow = min(lastRow or self.row_count,len(self.rows))
+        values = []
+        for row in self.rows[firstRow - 1:lastRow]:
+            cells = ['' if v is None else str(v) for v in row[firstCol - 1:lastCol]]
+            while cells and cells[-1] == '':
+                cells.pop()
+            values.append(cells)
+        #the API leaves out trailing empty rows but keeps the ones in between
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def writeRange(self,rangeName,values):
+        firstRow,firstCol,lastRow,lastCol = parseA1Range(rangeName)
+        firstRow = firstRow or 1
+        firstCol = firstCol or 1
+        if firstRow + len(values) - 1 > self.row_count:
+            raise SimulatedApiError(400,'Range ' + rangeName + ' exceeds grid limits')
+        for rowOffset,rowValues in enumerate(values):
+            rowIndex = firstRow - 1 + rowOffset
+            while len(self.rows) <= rowIndex:
+                self.rows.append([])
+            row = self.rows[rowIndex]
+            while len(row) < firstCol - 1 + len(rowValues):
+                row.append('')
+            row[firstCol - 1:firstCol - 1 + len(rowValues)] = list(rowValues)
+        self.backend.touch(self.fileId)
+
+    def col_values(self,col):
+        def read():
+            values = [str(row[col - 1]) if len(row) >= col and row[col - 1] is not None else ''
+                      for row in self.rows]
+            while values and values[-1] == '':
+                values.pop()
+            return values
+        return self.backend.call('sheets.read','sheets.col_values',read)
+
+    def batch_get(self,ranges,**kwargs):
+        return self.backend.call('sheets.read','sheets.batch_get',
+                                 lambda: [self.readRange(r) for r in ranges])
+
+    def update(self,values=None,range_name=None,**kwargs):
+        return self.backend.call('sheets.write','sheets.update',
+                                 lambda: self.writeRange(range_name,values))
+
+    def batch_update(self,data,**kwargs):
+        def write():
+            for valueRange in data:
+                self.writeRange(valueRange['range'],valueRange['values'])
+        return self.backend.call('sheets.write','sheets.batch_update',write)
+
+    def append_rows(self,values,**kwargs):
+        def append():
+            nextRow = len(self.readRange('A1:' + str(self.row_count))) + 1
+            if nextRow + len(values) - 1 > self.row_count:
+                self.row_count = nextRow + len(values) - 1
+            self.writeRange('A' + str(nextRow),values)
+        return self.backend.call('sheets.write','sheets.append_rows',append)
+
+    def add_rows(self,rows):
+        def grow():
+            self.row_count += rows
+        return self.backend.call('sheets.write','sheets.add_rows',grow)
+
+    def delete_rows(self,start_index,end_index=None):
+        def delete():
+            del self.rows[start_index - 1:end_index or start_index]
+            self.row_count -= (end_index or start_index) - start_index + 1
+            self.backend.touch(self.fileId)
+        return self.backend.call('sheets.write','sheets.delete_rows',delete)
+
+
+class MemoryBackend(StorageBackend):
+    '''keeps Drive folders and spreadsheets in memory so the whole script can be exercised
+    and measured without Google credentials. It can be seeded from the bundled .xlsx files
+    with fromConfig.
+
+    Every call sleeps for latency seconds and quotaErrorRate of single calls fail with a 429,
+    to see how the script copes with a slow or busy API. Drive batches only add latency.
+    callCounts counts the calls made for each operation. With a guard the calls go through
+    the same rate limiter and retries as the real ones'''
+
+    def __init__(self,latency=0.0,quotaErrorRate=0.0,guard=None,seed=None):
+        self.latency = latency
+        self.quotaErrorRate = quotaErrorRate
+        self.guard = guard
+        self.random = random.Random(seed)
+        self.files = {}
+        self.callCounts = {}
+        self.clock = 0
+        self.lock = threading.RLock()
+
+    def call(self,quota,opName,fn,cost=1,batch=False):
+        '''runs fn as one simulated API call'''
+        def simulatedCall():
+            with self.lock:
+                self.callCounts[opName] = self.callCounts.get(opName,0) + cost
+                failed = not batch and self.quotaErrorRate and self.random.random() < self.quotaErrorRate
+            if self.latency:
+                time.sleep(self.latency)
+            if failed:
+                raise SimulatedApiError(429,'Quota exceeded for ' + opName)
+            with self.lock:
+                return fn()
+        if self.guard is not None:
+            return self.guard.call(quota,opName,simulatedCall,cost=cost,retry=not batch)
+        return simulatedCall()
+
+    def touch(self,fileId):
+        #move the file's modifiedTime on - one simulated second per change
+        self.clock += 1
+        self.files[fileId]['modifiedTime'] = (datetime(2019,1,15) + timedelta(seconds=self.clock)).isoformat() + 'Z'
+
+    def newFile(self,name,mimeType,parents,fileId=None):
+        with self.lock:
+            fileId = fileId or 'mem-' + str(len(self.files) + 1)
+            self.files[fileId] = {'id' : fileId,'name' : name,'mimeType' : mimeType,
+                                  'parents' : list(parents or []),'sheets' : []}
+            self.touch(fileId)
+            self.files[fileId]['createdTime'] = self.files[fileId]['modifiedTime']
+            return fileId
+
+    def getFile(self,fileId):
+        if fileId not in self.files:
+            raise SimulatedApiError(404,'File not found: ' + str(fileId))
+        return self.files[fileId]
+
+    ######seeding
+
+    def addFolder(self,folderId,name,parents=None):
+        return self.newFile(name,FOLDER_MIME_TYPE,parents,folderId)
+
+    def addSpreadsheet(self,fileId,name,rows=None,parents=None):
+        fileId = self.newFile(name,SPREADSHEET_MIME_TYPE,parents,fileId)
+        self.files[fileId]['sheets'].append(MemoryWorksheet(self,fileId,rows))
+        return fileId
+
+    def addXlsxSpreadsheet(self,fileId,xlsxPath,parents=None):
+        '''adds a spreadsheet with the values of the first sheet of an .xlsx file (needs openpyxl)'''
+        return self.addSpreadsheet(fileId,os.path.splitext(os.path.basename(xlsxPath))[0],
+                                   readXlsxRows(xlsxPath),parents)
+
+    @classmethod
+    def fromConfig(cls,config,bundleDir=None,**kwargs):
+        '''builds a backend holding every folder and sheet the config refers to.
+        With bundleDir the form sheet and the two templates are loaded from the .xlsx files
+        shipped with this script, otherwise they start empty apart from the form header'''
+        backend = cls(**kwargs)
+        backend.addFolder(config['Folder Ids']['sarsParentFolderId'],'SARs')
+        backend.addFolder(config['Folder Ids']['deleteParentFolderId'],'Deletes')
+        bundled = [(config['DSAR Form Sheet']['dsarInputSheetId'],'[10] DSARInputFromForm[DO NOT REMOVE].xlsx'),
+                   (config['Template Ids']['sarSpreadheetTemplateId'],'SAR Template Sheet [DO NOT DELETE].xlsx'),
+                   (config['Template Ids']['deleteSpreadsheetTemplateId'],'DELETION DSR Template Sheet [DO NOT DELETE].xlsx')]
+        for fileId,fileName in bundled:
+            if bundleDir:
+                backend.addXlsxSpreadsheet(fileId,os.path.join(bundleDir,fileName))
+            else:
+                backend.addSpreadsheet(fileId,fileName)
+        if not bundleDir:
+            backend.files[config['DSAR Form Sheet']['dsarInputSheetId']]['sheets'][0].rows = [list(DSAR_FORM_HEADER)]
+        for route in getInputRoutes(config):
+            backend.addSpreadsheet(config['Input File Ids'][route.sheetIdKey],route.name)
+        backend.addSpreadsheet(config['LogFiles ID']['sarAutomationMaster'],'SAR Automation Log')
+        if config.has_option('Scale Out','claimLogSheetId'):
+            backend.addSpreadsheet(config['Scale Out']['claimLogSheetId'],'SAR Claim Log',[list(CLAIM_LOG_HEADER)])
+        return backend
+
+    ######StorageBackend
+
+    def createFolder(self,parentFolderId,folderName):
+        def create():
+            self.getFile(parentFolderId)
+            return self.addFolder(None,folderName,[parentFolderId])
+        return self.call('drive','drive.files.create',create)
+
+    def createFolders(self,folderRequests):
+        folderIds = {}
+        folderErrors = {}
+        for start in range(0,len(folderRequests),DRIVE_BATCH_SIZE):
+            chunk = folderRequests[start:start + DRIVE_BATCH_SIZE]
+            def createChunk():
+                for reference,parentFolderId,folderName in chunk:
+                    if reference in folderIds:
+                        continue
+                    try:
+                        self.getFile(parentFolderId)
+                        folderIds[reference] = self.addFolder(None,folderName,[parentFolderId])
+                    except Exception as e:
+                        folderErrors[reference] = e
+            self.call('drive','drive.batch',createChunk,cost=len(chunk),batch=True)
+        return folderIds,folderErrors
+
+    def copyFile(self,fileId,newName,parentFolderId=None):
+        def copyIt():
+            source = self.getFile(fileId)
+            newId = self.newFile(newName,source['mimeType'],
+                                 [parentFolderId] if parentFolderId else source['parents'])
+            for sheet in source['sheets']:
+                self.files[newId]['sheets'].append(
+                    MemoryWorksheet(self,newId,copy.deepcopy(sheet.rows),sheet.row_count,sheet.col_count))
+            return newId
+        return self.call('drive','drive.files.copy',copyIt)
+
+    def moveFile(self,fileId,sourceFolderId,destinationFolderId):
+        def move():
+            movedFile = self.getFile(fileId)
+            movedFile['parents'] = [p for p in movedFile['parents'] if p != sourceFolderId] + [destinationFolderId]
+        return self.call('drive','drive.files.update',move)
+
+    def getModifiedTime(self,fileId):
+        return self.call('drive','drive.files.get',lambda: self.getFile(fileId)['modifiedTime'])
+
+    def openWorksheet(self,spreadsheetId,sheetIndex=0):
+        #open_by_key and get_worksheet are two calls with gspread
+        self.call('sheets.read','sheets.open_by_key',lambda: self.getFile(spreadsheetId))
+        return self.call('sheets.read','sheets.get_worksheet',
+                         lambda: self.getFile(spreadsheetId)['sheets'][sheetIndex])
+
+    def writeCells(self,spreadsheetId,cellValues):
+        def write():
+            sheet = self.getFile(spreadsheetId)['sheets'][0]
+            for cell,value in cellValues:
+                sheet.writeRange(cell,[[value]])
+        return self.call('sheets.write','sheets.values_batch_update',write)
+
+    def downloadTemplate(self,fileId,xlsxPath):
+        def export():
+            import openpyxl
+            workBook = openpyxl.Workbook()
+            for row in self.getFile(fileId)['sheets'][0].rows:
+                workBook.active.append(row)
+            workBook.save(xlsxPath)
+        return self.call('drive','drive.files.export',export)
+
+    def uploadSpreadsheet(self,xlsxPath,newName,parentFolderId):
+        #read outside the call so uploads from several threads are not held up behind the lock
+        rows = readXlsxRows(xlsxPath)
+        def upload():
+            self.getFile(parentFolderId)
+            return self.addSpreadsheet(None,newName,rows,[parentFolderId])
+        return self.call('drive','drive.files.create',upload)
+
+    def listFiles(self,parentFolderId=None,nameContains=None,mimeType=None):
+        matches = []
+        def firstPage():
+            matches.extend(dict((key,f[key]) for key in ('id','name','mimeType','parents','createdTime'))
+                           for f in self.files.values()
+                           if (not parentFolderId or parentFolderId in f['parents']) and
+                              (not nameContains or nameContains in f['name']) and
+                              (not mimeType or f['mimeType'] == mimeType))
+            return matches[:DRIVE_LIST_PAGE_SIZE]
+        #one call for every page of results, as with files.list
+        files = self.call('drive','drive.files.list',firstPage)
+        for start in range(DRIVE_LIST_PAGE_SIZE,len(matches),DRIVE_LIST_PAGE_SIZE):
+            files.extend(self.call('drive','drive.files.list',
+                                   lambda start=start: matches[start:start + DRIVE_LIST_PAGE_SIZE]))
+        return files
+
+
+class SharedFileBackend(MemoryBackend):
+    '''a MemoryBackend whose files are kept in a JSON file at statePath, so several worker
+    processes can share one set of folders and sheets the way several machines share Drive.
+    Every call takes an exclusive lock on statePath.lock, loads whatever the other processes
+    have changed and saves its own changes before letting go, so each call is atomic across
+    the processes. The lock is an fcntl lock, so this only works on Unix'''
+
+    #calls that change nothing, so the state is not saved after them
+    READ_ONLY_OPS = set(['drive.files.get','drive.files.list','drive.files.export'])
+
+    def __init__(self,statePath,**kwargs):
+        MemoryBackend.__init__(self,**kwargs)
+        self.statePath = statePath
+        self.loadedVersion = None
+
+    def call(self,quota,opName,fn,cost=1,batch=False):
+        def sharedCall():
+            import fcntl
+            with open(self.statePath + '.lock','a') as lockFile:
+                fcntl.flock(lockFile.fileno(),fcntl.LOCK_EX)
+                try:
+                    self.loadState()
+                    result = fn()
+                    if quota != 'sheets.read' and opName not in self.READ_ONLY_OPS:
+                        self.saveState()
+                    return result
+                finally:
+                    fcntl.flock(lockFile.fileno(),fcntl.LOCK_UN)
+        return MemoryBackend.call(self,quota,opName,sharedCall,cost,batch)
+
+    def getStateVersion(self):
+        #the file is replaced on every save so its inode changes even if nothing else does
+        stat = os.stat(self.statePath)
+        return (stat.st_ino,stat.st_mtime_ns,stat.st_size)
+
+    def loadState(self):
+        '''reads the state file if another process has saved it since we last did. Worksheets
+        are updated in place so the handles callers hold stay good'''
+        if not os.path.exists(self.statePath) or self.getStateVersion() == self.loadedVersion:
+            return
+        with open(self.statePath) as f:
+            state = json.load(f)
+        self.clock = state['clock']
+        for fileId,fileState in state['files'].items():
+            sheetStates = fileState.pop('sheets')
+            memoryFile = self.files.setdefault(fileId,{'sheets' : []})
+            memoryFile.update(fileState)
+            for sheetIndex,sheetState in enumerate(sheetStates):
+                if sheetIndex == len(memoryFile['sheets']):
+                    memoryFile['sheets'].append(MemoryWorksheet(self,fileId))
+                sheet = memoryFile['sheets'][sheetIndex]
+                sheet.rows = sheetState['rows']
+                sheet.row_count = sheetState['rowCount']
+                sheet.col_count = sheetState['colCount']
+        self.loadedVersion = self.getStateVersion()
+
+    def saveState(self):
+        files = {}
+        for fileId,memoryFile in self.files.items():
+            files[fileId] = dict((key,value) for key,value in memoryFile.items() if key != 'sheets')
+            files[fileId]['sheets'] = [{'rows' : sheet.rows,'rowCount' : sheet.row_count,'colCount' : sheet.col_count}
+                                       for sheet in memoryFile['sheets']]
+        writeFileAtomically(self.statePath,json.dumps({'clock' : self.clock,'files' : files}))
+        self.loadedVersion = self.getStateVersion()
+
+
+def readXlsxRows(xlsxPath):
+    '''the values of the first sheet of an .xlsx file, formatted as Sheets shows them'''
+    import openpyxl
+    workBook = openpyxl.load_workbook(xlsxPath,read_only=True,data_only=True)
+    rows = [[formatXlsxValue(v) for v in row] for row in workBook.worksheets[0].iter_rows(values_only=True)]
+    workBook.close()
+    return rows
+
+
+def formatXlsxValue(value):
+    '''shows an .xlsx cell value the way Sheets formats it: dates as dd/mm/yyyy and
+    whole numbers without the .0'''
+    if value is None:
+        return ''
+    if isinstance(value,datetime):
+        if value.hour or value.minute or value.second:
+            return value.strftime('%d/%m/%Y %H:%M:%S')
+        return value.strftime('%d/%m/%Y')
+    if isinstance(value,float) and value.is_integer():
+        return str(int(value))
+    return str(value)
 
-    
-    
-           
 
 ######################Initialisation Routines################################################################################
 
 # Google Services of interest that we're interested in
-SCOPES = ['https://www.googleapis.com/auth/drive',                                                       
-          'https://www.googleapis.com/auth/drive.file',                                                  
+SCOPES = ['https://www.googleapis.com/auth/drive',
+          'https://www.googleapis.com/auth/drive.file',
           'https://www.googleapis.com/auth/spreadsheets']
 
-paramsPath = os.path.join(os.path.expanduser('~'),'ConfigFiles','params_olu.cfg')
-
-#set up access to the config file
+#set up access to the config file. It is read when the script is run
+#and can be filled in some other way when this file is imported
 config = configparser.RawConfigParser()
 
-#read the config
-config.read(paramsPath)
-
-gSpreadkey = config['GSpread Details']['gspread_key_file']
-gSpreadKeyPath = os.path.join(os.path.expanduser('~'),'ConfigFiles',gSpreadkey)
-
-googlekey = config['Google Drive']['google_key_file']
-googleKeyPath = os.path.join(os.path.expanduser('~'),'ConfigFiles',googlekey)
-
-#authenthicate for Google File Service
-gService = get_google_service(
-        api_name='drive',
-        api_version='v3',
-        scopes=SCOPES,
-        key_file_location=googleKeyPath)
-
-#Authenthicate for GSpread Use
-gc = authorizeGSpread(gSpreadKeyPath,SCOPES)
-
 ###########################Calling Defs start here##########################################################################
 
-#see that we can write to the log file
-logFileId = config['LogFiles ID']['sarAutomationMaster']
-writeToLog(gc,logFileId, getTimeString() + '  Process Started')
-
-#Get the spreadsheet ID from the config file
-#this workbook contains
-#the actual data on sheet 0
-dsarInputFormSheetId = config['DSAR Form Sheet']['dsarInputSheetId']
-
-#Connect to the spreadsheet and specific worksheets
-fs1 = connectToWorkbookSheet(gc,dsarInputFormSheetId,0)
-
-#old_records is a record of where the last SAR processing stopped
-#new_records is the current number of records in the spreadsheet
-
-#numRecInSheet = int(fs2.acell('a1').value)
-numRecInSheet = len(fs1.col_values(1)) - 1 #-1 to allow for the header row
-if numRecInSheet == 0:
-    #diff can be 0 if the systen is up to date
-    writeToLog(gc,logFileId,'No New SARs...Up to date')
-    writeToLog(gc,logFileId,'Process Finished at ' + getTimeString())
-    writeToLog(gc,logFileId,'***************')
-    sys.exit()
-
-#get new records as a list of a dictionary
-#recordsList = fs1.get_all_values()
-recordsList = fs1.get_all_records()
-totalRecordsInSheet = len(recordsList)
-#we now have a dictionary or the rows in a list
-#next we extract the rows to process from all rows in the spreadsheet
-newList = []
-for rec in recordsList:
-    if rec['Processed?'] == '':
-        newList.append(rec)
-
-numRecsToProcess = len(newList)
-if numRecsToProcess == 0:
-    #Despite there being records in the spreadsheet none need processing
-    writeToLog(gc,logFileId,'No New SARs...Up to date')
-    writeToLog(gc,logFileId,'Process Finished at ' + getTimeString())
-    writeToLog(gc,logFileId,'***************')
-    sys.exit()
-
-
-#if code gets here we have SARs to process
-writeToLog(gc,logFileId,'New SARs: ' + str(len(newList)))
-
-#Now we want to check for data integrity. We want to avoid a situation where
-#there is an action but no Reference Number given. So things can still fall
-#apart at this stage
-for item in newList:
-    if checkDataConsistency(item) == False:
-        writeToLog(gc,logFileId,'Inconsistent Data...Fields missing')
-        writeToLog(gc,logFileId,'Process Finished at ' + getTimeString())
-        sys.exit()
-        
-
-#now we will begin a loop to
-#1. create new subdirectory for the new SAR
-#2. create a copy of the SAR template for the new SAR
-#3. rename the copy
-#4. move the copy into the new subdirectory
-#5. fill out the header of the new SAR file
-
-i = 1 # starting index
-for item in newList:
-    #code will loop through all the requests picked up
-    #carry out the folder work as described above
-    
-    #subject requested for both action. The code will call the folderwork
-    #process and the set template header process twice
-    #one for access and one for delete
-
-    #set up the refs
-    delRef = 'D' + str(item['If Deletion Please Enter Next D-Number:'])
-    aRef = 'S' + str(item['If DSAR Please Enter Next S-Number:'])
-        
-    if (item['Action Required:'] == 'Both (Access and Deletion)'):
-        writeToLog(gc,logFileId,'Creating Folder And Summary Template For ' + aRef)
-        tFileId = doFolderWork(gService,
-                               item['Requester\'s Name:'],
-                               item['Enter DSR Email Address:'],
-                               item['If DSAR Please Enter Next S-Number:'],
-                               'Access'
-                               )
-        #set the template file headers
-        writeToLog(gc,logFileId,'Writing Header Info For ' + aRef)
-        setTemplateFileHeader(gc,
-                          tFileId,
-                          item['Requester\'s Name:'],
-                          item['Enter DSR Email Address:'],
-                          aRef,
-                          item['Received Date:'],    
-                          item['Due Date:'],
-                          'No') #default
-        
-        #now do the same for the delete part
-        writeToLog(gc,logFileId,'Creating Folder And Summary Template For ' + delRef)
-        tFileId = doFolderWork(gService,
-                               item['Requester\'s Name:'],
-                               item['Enter DSR Email Address:'],
-                               item['If Deletion Please Enter Next D-Number:'],
-                               'Delete'
-                               )
-        #set the template file headers
-        writeToLog(gc,logFileId,'Writing Header Info For ' + delRef)
-        setTemplateFileHeader(gc,
-                          tFileId,
-                          item['Requester\'s Name:'],
-                          item['Enter DSR Email Address:'],
-                          delRef,
-                          item['Received Date:'],    
-                          item['Due Date:'],
-                          'No')
-
-    #this is the process just for the access
-    if (item['Action Required:'] == 'Access To Information'):
-        writeToLog(gc,logFileId,'Creating Folder And Summary Template For ' + aRef)
-        tFileId = doFolderWork(gService,
-                               item['Requester\'s Name:'],
-                               item['Enter DSR Email Address:'],
-                               item['If DSAR Please Enter Next S-Number:'],
-                               'Access'
-                               )
-        #set the template file headers
-        writeToLog(gc,logFileId,'Writing Header Info For ' + aRef)
-        setTemplateFileHeader(gc,
-                          tFileId,
-                          item['Requester\'s Name:'],
-                          item['Enter DSR Email Address:'],
-                          aRef,
-                          item['Received Date:'],    
-                          item['Due Date:'],
-                          'No')
-        
-    #this is the process just for the delete
-    if (item['Action Required:'] == 'Deletion (Deletion Of Information)'):
-        writeToLog(gc,logFileId,'Creating Folder For ' + delRef)
-        tFileId = doFolderWork(gService,
-                               item['Requester\'s Name:'],
-                               item['Enter DSR Email Address:'],
-                               item['If Deletion Please Enter Next D-Number:'],
-                               'Delete'
-                               )
-        #set the template file headers
-        writeToLog(gc,logFileId,'Writing Header Info For ' + delRef)
-        setTemplateFileHeader(gc,
-                          tFileId,
-                          item['Requester\'s Name:'],
-                          item['Enter DSR Email Address:'],
-                          delRef,
-                          item['Received Date:'],    
-                          item['Due Date:'],
-                          'No')
-
-    updateSpreadsheetRecord(fs1,totalRecordsInSheet,numRecsToProcess,i)
-    i+=1 #increase the counter for the next process
-        
-#After the file work and template header work is done,
-#we now need to fill out the input sheets in readiness for the cron
-#proceses to pick up and process
-        
-writeToLog(gc,logFileId,'Filling Input Sheets')
-
-fillAllInputSheets(gc,newList)
-
-writeToLog(gc,logFileId, getTimeString() + '  Process Ended')
-writeToLog(gc,logFileId, '******************') #separator
+def runSarProcess(backend,logger,metrics=None,formModifiedTime=None,quiet=False):
+    '''the whole SAR process against a storage backend. It returns the form records
+    that were processed in this run. With metrics the API calls are recorded against
+    the stage of the run they were made in. A caller that has just read the form sheet's
+    modifiedTime can pass it in to save reading it again. With quiet a run that finds the
+    form sheet unchanged logs nothing, so it never connects to Sheets'''
+
+    def setStage(stage):
+        if metrics is not None:
+            metrics.setStage(stage)
+
+    #the guard lives as long as the backend, so this run's calls are counted from here
+    guardCounters = backend.guard.snapshot() if backend.guard is not None else None
+
+    setStage('form scan')
+
+    #Get the spreadsheet ID from the config file
+    #this workbook contains
+    #the actual data on sheet 0
+    dsarInputFormSheetId = config['DSAR Form Sheet']['dsarInputSheetId']
+
+    #the form sheet only ever grows so we only read the rows after the watermark,
+    #and skip the run altogether if the sheet has not changed since the last one.
+    #Every fullScanHours the whole sheet is read again to pick up anything missed
+    watermarkPath = config.get('State','watermarkFile',
+                               fallback=os.path.join(os.path.expanduser('~'),'ConfigFiles','sar_watermark.json'))
+    watermark = loadWatermark(watermarkPath)
+    fullScan = isFullScanDue(watermark,config.getfloat('State','fullScanHours',fallback=24))
+
+    #the journal has whatever an earlier run started but did not finish
+    journal = openStageJournal()
+    unfinishedRecords = journal.unfinishedRecords()
+
+    #the change check comes before anything is logged so that a quiet run with nothing
+    #to do only ever makes this one Drive call
+    modifiedTimeError = None
+    if formModifiedTime is None:
+        try:
+            formModifiedTime = backend.getModifiedTime(dsarInputFormSheetId)
+        except Exception as e:
+            #without the modified time we cannot tell so just scan
+            modifiedTimeError = e
+    unchanged = (not fullScan and formModifiedTime is not None and
+                 formModifiedTime == watermark['modifiedTime'] and not unfinishedRecords)
+    if unchanged and quiet:
+        return []
+
+    logger.log(getTimeString() + '  Process Started')
+    if modifiedTimeError is not None:
+        logger.log('Could Not Read DSAR Form Modified Time: ' + str(modifiedTimeError))
+
+    if unchanged:
+        logger.log('No Changes To DSAR Form...Up to date')
+        logger.log('Process Finished at ' + getTimeString())
+        logger.log('***************')
+        logger.flush()
+        return []
+
+    #see that we can write to the log file
+    logger.flush()
+
+    startRow = 2 if fullScan else watermark['lastProcessedRow'] + 1
+
+    #Connect to the spreadsheet and specific worksheets
+    fs1 = backend.openWorksheet(dsarInputFormSheetId,0)
+
+    #get new records as a list of a dictionary
+    recordsList = readFormRecords(fs1,startRow)
+    #we now have a dictionary or the rows in a list
+    #next we extract the rows to process from the rows read
+    newList = []
+    for rec in recordsList:
+        if rec['Processed?'] == '':
+            newList.append(rec)
+
+    def updateWatermark(stampedRecords):
+        '''moves the watermark on past every row that is now processed, stopping at the
+        first row that is still waiting'''
+        stampedIds = set(id(rec) for rec in stampedRecords)
+        lastProcessedRow = startRow - 1
+        for rec in recordsList:
+            if rec['Processed?'] == '' and id(rec) not in stampedIds:
+                break
+            lastProcessedRow = rec['_sheetRow']
+        watermark['lastProcessedRow'] = lastProcessedRow
+        #this is the time from before our own Processed stamps, so the next run does one
+        #cheap read of the rows past the watermark rather than risk missing a submission
+        watermark['modifiedTime'] = formModifiedTime
+        if fullScan:
+            watermark['lastFullScan'] = datetime.strftime(datetime.now(),'%Y-%m-%dT%H:%M:%S')
+        saveWatermark(watermarkPath,watermark)
+
+    newKeys = set(getRecordKey(rec) for rec in newList)
+
+    #with scale out this worker only takes on the rows it wins a lease on, and only
+    #finishes the unfinished records of rows no other worker has taken over since
+    scaleOut = config.getboolean('Scale Out','enabled',fallback=False)
+    if scaleOut and (newList or unfinishedRecords):
+        setStage('claiming')
+        waitingCount = len(newList)
+        newList,holders = claimFormRows(backend,newList,unfinishedRecords)
+        workerId = getWorkerId()
+        for rec in unfinishedRecords:
+            holder = holders.get(rec['_sheetRow'])
+            if holder is not None and holder[0] != workerId:
+                #our lease ran out and another worker has the row now - it may even have
+                #finished and stamped it, so nothing more is done for it here
+                journal.record(getRecordKey(rec),'released')
+        unfinishedRecords = [rec for rec in unfinishedRecords if journal.get(getRecordKey(rec),'released') is None]
+        #the form sheet was read before the claims were made, and the worker that had a row
+        #before may have stamped it in between
+        stampedRows = getStampedRows(fs1,[rec['_sheetRow'] for rec in newList],
+                                     config.getint('DSAR Form Sheet','processedColumn',fallback=3))
+        newList = [rec for rec in newList if rec['_sheetRow'] not in stampedRows]
+        #a row taken over from a worker that died may have its folder and template already
+        adoptAbandonedWork(backend,journal,[rec for rec in newList if holders[rec['_sheetRow']][2] is not None])
+        logger.log('Claimed ' + str(len(newList)) + ' of ' + str(waitingCount) + ' Waiting Rows As ' + workerId)
+        setStage('form scan')
+
+    #unfinished records from the journal that are not waiting in the form sheet again
+    #have been stamped already and only need their input sheets filled
+    resumedRecords = [rec for rec in unfinishedRecords if getRecordKey(rec) not in newKeys]
+    for rec in resumedRecords:
+        if journal.get(getRecordKey(rec),'stamped') is None:
+            #the stamp went in but the run died before it reached the journal
+            journal.record(getRecordKey(rec),'stamped')
+
+    numRecsToProcess = len(newList)
+    if numRecsToProcess == 0 and not resumedRecords:
+        #Despite there being records in the spreadsheet none need processing
+        updateWatermark([])
+        #drops any records released to other workers
+        journal.compact()
+        logger.log('No New SARs...Up to date')
+        logger.log('Process Finished at ' + getTimeString())
+        logger.log('***************')
+        logger.flush()
+        return []
+
+
+    #if code gets here we have SARs to process
+    logger.log('New SARs: ' + str(len(newList)))
+    if unfinishedRecords:
+        logger.log('Resuming ' + str(len(unfinishedRecords)) + ' Unfinished SARs From The Journal')
+    logger.flush()
+
+    #the Processed stamps for the run are written together at the end, or every
+    #stampCheckpointEvery records so a long run does not hold them all back
+    stamper = ProcessedStamper(fs1,
+                               config.getint('DSAR Form Sheet','processedColumn',fallback=3),
+                               config.getint('Performance','stampCheckpointEvery',fallback=0),
+                               journal,
+                               (lambda rowNumbers: renewLeases(backend,rowNumbers)) if scaleOut else None)
+
+    setStage('validation')
+    #Now we want to check for data integrity. We want to avoid a situation where
+    #there is an action but no Reference Number given, or a Reference Number another
+    #row has already. A record like that is quarantined - stamped with what is
+    #wrong with it - and the rest carry on
+    validList = []
+    quarantinedList = []
+    #the references of the rows this worker is still finishing from an earlier run
+    referenceRows = dict((ref,rec['_sheetRow']) for rec in unfinishedRecords
+                         for sarAction,refNumber,ref in getRequestReferences(rec))
+    index = openArtifactIndex()
+    try:
+        for item in newList:
+            missingFields = getMissingFields(item)
+            duplicates = []
+            if not missingFields and journal.get(getRecordKey(item),'accepted') is None:
+                #a record accepted by an earlier run is being resumed and its references are its own
+                duplicates = getDuplicateReferences(item,referenceRows,index)
+            if missingFields or duplicates:
+                reason = 'missing ' + ', '.join(missingFields) if missingFields else describeDuplicates(duplicates)
+                logger.log('Quarantined Form Row ' + str(item['_sheetRow']) + ': ' + reason)
+                stamper.quarantine(item,reason)
+                quarantinedList.append(item)
+                if metrics is not None:
+                    metrics.reject(item['_sheetRow'],missingFields,[ref for ref,otherRow in duplicates])
+            else:
+                journal.accept(item)
+                validList.append(item)
+                for sarAction,refNumber,ref in getRequestReferences(item):
+                    referenceRows.setdefault(ref,item['_sheetRow'])
+    finally:
+        index.close()
+    if quarantinedList:
+        logger.log('Rejected ' + str(len(quarantinedList)) + ' of ' + str(len(newList)) + ' New SARs')
+    newList = validList
+
+
+    #now we will begin a loop to
+    #1. create new subdirectory for the new SAR
+    #2. create a copy of the SAR template for the new SAR straight into the new subdirectory
+    #3. fill out the header of the new SAR file
+    #the subdirectories for all the requests are created up front in Drive batches
+
+    setStage('folder creation')
+    folderIds = createRequestFolders(backend,logger,newList,journal)
+
+    setStage('request processing')
+    templateCache = openTemplateCache(backend)
+    processedList = []
+    artifacts = []
+    requestResults = processRequests(
+        backend,logger,newList,folderIds,
+        parallel=config.getboolean('Performance','parallelRequests',fallback=False),
+        maxWorkers=config.getint('Performance','requestWorkers',fallback=4),
+        templateCache=templateCache,
+        journal=journal)
+    for item,templateFiles,requestError in requestResults:
+        #results come back in form order so the records are stamped in order
+        if requestError is not None:
+            #with parallelRequests the log lines of requests are interleaved so say which one it was
+            logger.log('Failed To Process Request For Form Row ' + str(item['_sheetRow']) + ' (' +
+                       ', '.join(ref for sarAction,refNumber,ref in getRequestReferences(item)) + '): ' +
+                       str(requestError))
+        elif templateFiles is not None:
+            stamper.stamp(item)
+            processedList.append(item)
+            artifacts.extend((ref,sarAction,folderId,tFileId,item['_sheetRow'])
+                             for ref,sarAction,folderId,tFileId in templateFiles)
+        #a record whose folder could not be made is left for the next run
+
+    #keep the folder and template ids of every reference so they never have to be
+    #searched for in Drive
+    index = openArtifactIndex()
+    try:
+        index.record(artifacts)
+    finally:
+        index.close()
+
+    setStage('stamping')
+    stamper.commit()
+    if stamper.released:
+        #the run outlasted its leases on these rows and another worker has them now
+        logger.log('Lost The Lease On Form Rows ' + ', '.join(str(rowNo) for rowNo in sorted(stamper.released)) +
+                   ' To Another Worker')
+        processedList = [rec for rec in processedList if rec['_sheetRow'] not in stamper.released]
+        quarantinedList = [rec for rec in quarantinedList if rec['_sheetRow'] not in stamper.released]
+    #quarantined rows are stamped as well so the watermark can move past them
+    updateWatermark(processedList + quarantinedList)
+    logger.flush()
+
+    #After the file work and template header work is done,
+    #we now need to fill out the input sheets in readiness for the cron
+    #proceses to pick up and process
+
+    setStage('input sheets')
+    fillList = processedList + resumedRecords
+    if scaleOut and fillList:
+        #the leases are renewed again, so no other worker fills these rows in as well
+        heldRows = renewLeases(backend,[rec['_sheetRow'] for rec in fillList])
+        for rec in fillList:
+            if rec['_sheetRow'] not in heldRows:
+                logger.log('Lost The Lease On Form Row ' + str(rec['_sheetRow']) + ' Before Its Input Rows Were Written')
+                journal.record(getRecordKey(rec),'released')
+        fillList = [rec for rec in fillList if rec['_sheetRow'] in heldRows]
+    logger.log('Filling Input Sheets')
+    logger.flush()
+
+    inputSheetResults = fillAllInputSheets(
+        backend,fillList,
+        parallel=config.getboolean('Performance','parallelInputSheets',fallback=False),
+        maxWorkers=config.getint('Performance','inputSheetWorkers',fallback=4),
+        journal=journal)
+    for sheetName,sheetError in inputSheetResults:
+        if sheetError is None:
+            logger.log('Filled Input Sheet ' + sheetName)
+        else:
+            logger.log('Failed To Fill Input Sheet ' + sheetName + ': ' + str(sheetError))
+
+    #only what is still unfinished stays in the journal
+    journal.compact()
+    if scaleOut:
+        #and the claim log's oldest lines go once they are for stamped rows
+        try:
+            prunedLines = pruneClaimLog(backend,watermark['lastProcessedRow'])
+            if prunedLines:
+                logger.log('Pruned ' + str(prunedLines) + ' Lines From The Claim Log')
+        except Exception as e:
+            logger.log('Could Not Prune The Claim Log: ' + str(e))
+
+    setStage('logging')
+    if backend.guard is not None:
+        logger.log(backend.guard.summary(guardCounters))
+    if metrics is not None:
+        metrics.processed = len(processedList)
+    logger.log(getTimeString() + '  Process Ended')
+    logger.log('******************') #separator
+    logger.flush()
+    return processedList
+
+
+def runWithMetrics(backend,logger,formModifiedTime=None,quiet=False,scriptSeconds=None):
+    '''one run of the process with its API calls recorded and the metrics exported at the end.
+    scriptSeconds is how long the script took to get going, if this is the first run'''
+    metrics = RunMetrics()
+    if scriptSeconds is not None:
+        metrics.startup['script'] = scriptSeconds
+    clientSeconds = getattr(backend,'clientSeconds',0.0)
+    if backend.guard is not None:
+        backend.guard.observers.append(metrics.record)
+    try:
+        return runSarProcess(backend,logger,metrics,formModifiedTime,quiet)
+    finally:
+        if backend.guard is not None:
+            backend.guard.observers.remove(metrics.record)
+        metrics.startup['clients'] = getattr(backend,'clientSeconds',0.0) - clientSeconds
+        exportRunMetrics(metrics,logger)
+        logger.flush()
+
+
+class RetryBackoff(object):
+    '''when the daemon next runs only to retry the requests the journal has unfinished.
+    The wait doubles from pollSeconds up to maxSeconds every time a run leaves requests
+    unfinished, so a request that keeps failing does not cost a full run, and its log lines,
+    on every poll. It starts again once the journal is empty'''
+
+    def __init__(self,pollSeconds,maxSeconds):
+        self.pollSeconds = pollSeconds
+        self.maxSeconds = maxSeconds
+        self.failedRuns = 0
+        self.nextRetry = 0.0
+
+    def isDue(self):
+        return time.monotonic() >= self.nextRetry
+
+    def update(self,unfinishedRecords):
+        if not unfinishedRecords:
+            self.failedRuns = 0
+            self.nextRetry = 0.0
+            return
+        self.failedRuns += 1
+        self.nextRetry = time.monotonic() + min(self.maxSeconds,self.pollSeconds * 2 ** self.failedRuns)
+
+
+def runDaemon(backend,logger,pollSeconds=30,maxRetrySeconds=3600):
+    '''keeps running with the same authenticated clients instead of starting afresh from cron.
+    Every pollSeconds it reads the DSAR form sheet's modifiedTime from Drive - one cheap call -
+    and only runs the process when it has changed, or when the journal has requests an
+    earlier run did not finish and its RetryBackoff is due. It stops after the current poll
+    or run on SIGTERM or SIGINT'''
+    stopping = threading.Event()
+    def stop(signum,frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM,stop)
+    signal.signal(signal.SIGINT,stop)
+
+    dsarInputFormSheetId = config['DSAR Form Sheet']['dsarInputSheetId']
+    lastSeenModifiedTime = None
+    retryBackoff = RetryBackoff(pollSeconds,maxRetrySeconds)
+    logger.log(getTimeString() + '  Daemon Started, polling every ' + str(pollSeconds) + 's')
+    logger.flush()
+    while not stopping.is_set():
+        try:
+            formModifiedTime = backend.getModifiedTime(dsarInputFormSheetId)
+            #an interrupted request is tried again without waiting for someone to fill
+            #in the form, backing off while it keeps failing
+            if formModifiedTime != lastSeenModifiedTime or (retryBackoff.isDue() and
+                                                            openStageJournal().unfinishedRecords()):
+                try:
+                    runWithMetrics(backend,logger,formModifiedTime)
+                    #our own Processed stamps move the modifiedTime on as well, so the next
+                    #poll will do one more quick run that finds nothing new
+                    lastSeenModifiedTime = formModifiedTime
+                finally:
+                    retryBackoff.update(openStageJournal().unfinishedRecords())
+        except Exception as e:
+            logger.log(getTimeString() + '  Daemon Run Failed: ' + str(e))
+            logger.flush()
+        stopping.wait(pollSeconds)
+    logger.log(getTimeString() + '  Daemon Stopped')
+    logger.flush()
+
+
+def makeGoogleBackend():
+    '''the Google backend for the key files named in the config'''
+    gSpreadkey = config['GSpread Details']['gspread_key_file']
+    gSpreadKeyPath = os.path.join(os.path.expanduser('~'),'ConfigFiles',gSpreadkey)
+
+    googlekey = config['Google Drive']['google_key_file']
+    googleKeyPath = os.path.join(os.path.expanduser('~'),'ConfigFiles',googlekey)
+
+    #the Drive discovery document is saved here the first time so later runs build the
+    #client from disk instead of fetching it
+    discoveryCacheDir = config.get('Google Drive','discoveryCacheDir',
+                                   fallback=os.path.join(os.path.expanduser('~'),'ConfigFiles','discovery'))
+
+    #both clients get their credentials from here, so a key file is read once and every
+    #client made from it shares its token
+    credentialCache = CredentialCache(SCOPES)
+
+    #each Drive client is used by one thread at a time, as httplib2 cannot be shared, but
+    #the threads all share one gspread client whose session keeps a pool of connections open for them
+    poolSize = max(config.getint('Performance','requestWorkers',fallback=4),
+                   config.getint('Performance','inputSheetWorkers',fallback=4)) + 2
+    sheetsFactory = makeSharedFactory(
+        #Authenthicate for GSpread Use
+        lambda: authorizeGSpread(gSpreadKeyPath,SCOPES,credentialCache.get(gSpreadKeyPath),poolSize))
+
+    #every Drive and Sheets call goes through the guard so the whole run shares one
+    #rate limiter and retry policy, including the clients made for worker threads
+    return GoogleBackend(
+        #authenthicate for Google File Service
+        lambda: get_google_service(api_name='drive',
+                                   api_version='v3',
+                                   scopes=SCOPES,
+                                   key_file_location=googleKeyPath,
+                                   discoveryCacheDir=discoveryCacheDir,
+                                   credentials=credentialCache.get(googleKeyPath)),
+        sheetsFactory,
+        ApiGuard.fromConfig(config))
+
+
+def runIndexCommand(backend,args):
+    '''the index subcommands. Entries are printed as tab separated
+    ref, action, folder id, template file id, created at and form row'''
+    index = openArtifactIndex()
+    try:
+        if args.indexCommand == 'rebuild':
+            print('Indexed ' + str(index.rebuild(backend)) + ' references')
+            return 0
+        if args.indexCommand == 'lookup':
+            entries = [index.lookup(ref) for ref in args.refs]
+            for ref,entry in zip(args.refs,entries):
+                if entry is None:
+                    sys.stderr.write(ref + ' is not in the index\n')
+            entries = [entry for entry in entries if entry is not None]
+        else:
+            entries = index.list(args.action,args.since)
+        for entry in entries:
+            print('\t'.join('' if entry[column] is None else str(entry[column])
+                            for column in ArtifactIndex.COLUMNS))
+        return 0 if len(entries) == len(getattr(args,'refs',entries)) else 1
+    finally:
+        index.close()
+
+
+def runBackfillCommand(backend,logger,args):
+    '''the backfill subcommand. Progress goes to stderr after every chunk. With --dry-run
+    nothing is made and the API calls it would take are printed instead'''
+    maxWorkers = args.workers or config.getint('Performance','requestWorkers',fallback=4)
+    journalPath = getBackfillJournalPath(args.exportFile)
+    def showProgress(counts):
+        sys.stderr.write('\r' + formatBackfillCounts(counts))
+        sys.stderr.flush()
+
+    if args.dry_run:
+        counts,roundTrips = planBackfill(args.exportFile,journalPath,args.chunk_size,maxWorkers,
+                                         not args.skip_input_sheets,showProgress)
+        sys.stderr.write('\n')
+        print('Would import: ' + formatBackfillCounts(counts))
+        for opName in sorted(roundTrips):
+            print('%-32s %8d' % (opName,roundTrips[opName]))
+        driveCalls = sum(n for opName,n in roundTrips.items() if opName.startswith('drive'))
+        sheetsCalls = sum(n for opName,n in roundTrips.items() if opName.startswith('sheets'))
+        print('Planned API calls: ' + str(driveCalls + sheetsCalls) +
+              ' (Drive ' + str(driveCalls) + ', Sheets ' + str(sheetsCalls) + ')')
+        return 0
+
+    index = openArtifactIndex()
+    try:
+        counts = runBackfill(backend,logger,args.exportFile,StageJournal(journalPath),index,args.chunk_size,
+                             maxWorkers,not args.skip_input_sheets,openTemplateCache(backend),showProgress)
+    finally:
+        index.close()
+    sys.stderr.write('\n')
+    print(formatBackfillCounts(counts))
+    return 1 if counts['failed'] else 0
+
+
+def main(argv=None):
+    '''the command line. run, the default, does one run for cron, daemon keeps going,
+    index answers questions from the artifact index and backfill imports an export'''
+    parser = argparse.ArgumentParser(description='Folder and spreadsheet work for new SAR requests')
+    parser.add_argument('--config',default=os.path.join(os.path.expanduser('~'),'ConfigFiles','params_olu.cfg'),
+                        help='the params file to read')
+    commands = parser.add_subparsers(dest='command')
+    runParser = commands.add_parser('run',help='process new requests once and exit (the default)')
+    runParser.add_argument('--quiet',action='store_true',
+                           help='log nothing when the form sheet has not changed')
+    daemonParser = commands.add_parser('daemon',help='keep running and poll the form sheet for changes')
+    daemonParser.add_argument('--poll-seconds',type=float,default=None,
+                              help='seconds between polls, overrides [Daemon] pollSeconds')
+    indexParser = commands.add_parser('index',help='look up the folder and template made for a reference')
+    indexCommands = indexParser.add_subparsers(dest='indexCommand')
+    indexCommands.required = True
+    lookupParser = indexCommands.add_parser('lookup',help='show the index entry for references')
+    lookupParser.add_argument('refs',nargs='+',help='S or D references, e.g. S123')
+    listParser = indexCommands.add_parser('list',help='show every index entry')
+    listParser.add_argument('--action',choices=['Access','Delete'],help='only this action')
+    listParser.add_argument('--since',help='only entries made since this ISO date or time')
+    indexCommands.add_parser('rebuild',help='fill the index again from the folders in Drive')
+    backfillParser = commands.add_parser('backfill',help='import historical requests from an export of the form sheet')
+    backfillParser.add_argument('exportFile',help='an .xlsx or .csv file laid out like DSARInputFromForm')
+    backfillParser.add_argument('--dry-run',action='store_true',
+                                help='make nothing and print the API calls the import would take')
+    backfillParser.add_argument('--chunk-size',type=int,default=DRIVE_BATCH_SIZE,
+                                help='rows read and worked on at a time')
+    backfillParser.add_argument('--workers',type=int,default=None,
+                                help='threads for the template work, overrides [Performance] requestWorkers')
+    backfillParser.add_argument('--skip-input-sheets',action='store_true',
+                                help='do not add the requests to the input sheets, for ones already dealt with')
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    #--daemon was the switch before there were subcommands
+    if '--daemon' in argv:
+        argv.remove('--daemon')
+        argv.append('daemon')
+    args = parser.parse_args(argv)
+
+    #read the config
+    config.read(args.config)
+
+    if args.command == 'index' and args.indexCommand != 'rebuild':
+        #answered from the local index alone, without connecting to Google
+        return runIndexCommand(None,args)
+    if args.command == 'backfill' and args.dry_run:
+        #planned against a MemoryBackend, without connecting to Google
+        return runBackfillCommand(None,None,args)
+
+    backend = makeGoogleBackend()
+    if args.command == 'index':
+        return runIndexCommand(backend,args)
+
+    #log lines are buffered and written at stage boundaries. The atexit hook makes sure
+    #whatever is still buffered goes out on every exit path as well
+    logFileId = config['LogFiles ID']['sarAutomationMaster']
+    logger = SheetLogger(backend,logFileId,config.get('LogFiles ID','localLogMirror',fallback=None),
+                         append=config.getboolean('Scale Out','enabled',fallback=False))
+    atexit.register(logger.flush)
+
+    if args.command == 'backfill':
+        return runBackfillCommand(backend,logger,args)
+
+    #every Drive and Sheets call of a run is timed and exported when it ends
+    if args.command == 'daemon':
+        pollSeconds = args.poll_seconds
+        if pollSeconds is None:
+            pollSeconds = config.getfloat('Daemon','pollSeconds',fallback=30)
+        runDaemon(backend,logger,pollSeconds,config.getfloat('Daemon','maxRetrySeconds',fallback=3600))
+    else:
+        runWithMetrics(backend,logger,quiet=getattr(args,'quiet',False),
+                       scriptSeconds=time.perf_counter() - SCRIPT_STARTED)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
 
 ##############THE END##############################################
-
-
- 
-        
-        
-    
-    
-
-
-
-
-
-
-
-
-
-
-
-
-
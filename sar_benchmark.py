@@ -0,0 +1,236 @@
+###############################################################################################################################
+"""#Benchmark for the SAR process
+#
+#Runs the whole SAR process (form scan, getMissingFields, doFolderWork, setTemplateFileHeader,
+#updateSpreadsheetRecord, fillAllInputSheets and the log writes) against the in-memory storage
+#backend for a range of backlog sizes and reports, for each size:
+#   API calls per request
+#   Drive and Sheets quota units used
+#   wall time
+#   peak memory
+#
+#Every simulated API call sleeps for --latency seconds so the numbers track what a real run
+#spends waiting on the network. Pending requests are a mix of Access, Delete and Both.
+#
+#With --scale-out N the first size is instead worked through by N worker processes sharing
+#one SharedFileBackend, each claiming rows in the [Scale Out] claim log, and the run checks that
+#every row was processed exactly once.
+#
+#usage: python sar_benchmark.py [--sizes 1 10 100 1000] [--latency 0.01] [--parallel] [--local-templates]
+#                               [--scale-out 4]
+###############################################################################################################################"""
+
+import argparse,importlib.util,json,multiprocessing,os,shutil,sys,tempfile,time,tracemalloc
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#the Action Required: answers in the order the benchmark hands them out
+ACTIONS = ['Access To Information','Deletion (Deletion Of Information)','Both (Access and Deletion)']
+
+
+def loadSarScript():
+    '''the SAR script's file name has a dash in it so it is loaded by path.
+    The libraries the script loads lazily are imported here as well, so the time and
+    memory they take are not counted against the first size measured'''
+    spec = importlib.util.spec_from_file_location(
+        'sar_automation_master',os.path.join(SCRIPT_DIR,'sar_automation_master-v4.py'))
+    sar = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sar)
+    for moduleName in ('sqlite3','gspread','gspread.utils','openpyxl','httplib2','requests.adapters',
+                       'googleapiclient.discovery','googleapiclient.http','google.oauth2.service_account',
+                       'google.auth.transport.requests','google_auth_httplib2'):
+        try:
+            importlib.import_module(moduleName)
+        except ImportError:
+            #the in-memory backend does not need the Google client libraries
+            pass
+    return sar
+
+
+def benchmarkConfig(sar,stateDir,parallel,localTemplates=False):
+    '''a config with made up ids for every folder and sheet the process touches'''
+    return {
+        'Folder Ids' : {'sarsParentFolderId' : 'sar-parent','deleteParentFolderId' : 'delete-parent'},
+        'Template Ids' : {'sarSpreadheetTemplateId' : 'sar-template',
+                          'deleteSpreadsheetTemplateId' : 'delete-template'},
+        'DSAR Form Sheet' : {'dsarInputSheetId' : 'dsar-form'},
+        'Input File Ids' : dict((route[1],'input-' + route[0]) for route in sar.DEFAULT_INPUT_ROUTES),
+        'LogFiles ID' : {'sarAutomationMaster' : 'log-sheet'},
+        'Header Info Locations' : {'referenceValueCell' : 'B1','nameValueCell' : 'B2',
+                                   'emailValueCell' : 'B3','datereceivedValueCell' : 'B4',
+                                   'datedueValueCell' : 'B5','identityconfirmedValueCell' : 'B6'},
+        'State' : {'watermarkFile' : os.path.join(stateDir,'watermark.json'),
+                   'indexFile' : os.path.join(stateDir,'index.sqlite'),
+                   'journalFile' : os.path.join(stateDir,'journal.jsonl')},
+        'Performance' : {'parallelRequests' : 'yes' if parallel else 'no',
+                         'parallelInputSheets' : 'yes' if parallel else 'no',
+                         'requestWorkers' : '8','inputSheetWorkers' : '8'},
+        'Templates' : {'renderLocally' : 'yes' if localTemplates else 'no',
+                       'cacheDir' : os.path.join(stateDir,'templates')},
+        'Scale Out' : {'claimLogSheetId' : 'claim-log'},
+        }
+
+
+def pendingFormRows(count):
+    '''count unprocessed form rows laid out like DSARInputFromForm'''
+    rows = []
+    for i in range(count):
+        identityId = str(15000000 + i) if i % 2 == 0 else ''
+        rows.append(['18/03/2019 10:49:24','privacy.team@example.com','',
+                     'subject' + str(i) + '@example.com','Subject ' + str(i),ACTIONS[i % 3],
+                     str(1000 + i),str(5000 + i),'','PrivacyOnlyTeam','18/03/2019',
+                     identityId,'19/04/2019'])
+    return rows
+
+
+def runOnce(sar,size,latency,parallel,localTemplates=False):
+    '''runs the process once over size pending requests and returns its measurements'''
+    stateDir = tempfile.mkdtemp()
+    try:
+        sar.config.clear()
+        sar.config.read_dict(benchmarkConfig(sar,stateDir,parallel,localTemplates))
+        #a guard with no rate limits so every call is recorded by RunMetrics without being slowed
+        guard = sar.ApiGuard({})
+        metrics = sar.RunMetrics()
+        guard.observers.append(metrics.record)
+        backend = sar.MemoryBackend.fromConfig(sar.config,latency=latency,guard=guard)
+        formSheet = backend.files['dsar-form']['sheets'][0]
+        formSheet.rows.extend(pendingFormRows(size))
+        formSheet.row_count = max(formSheet.row_count,len(formSheet.rows))
+        logger = sar.SheetLogger(backend,'log-sheet')
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        processed = sar.runSarProcess(backend,logger,metrics)
+        metrics.finish()
+        wallTime = time.perf_counter() - started
+        peakMemory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        driveUnits = sum(n for op,n in backend.callCounts.items() if op.startswith('drive'))
+        sheetsUnits = sum(n for op,n in backend.callCounts.items() if op.startswith('sheets'))
+        #a Drive batch is one round trip however many requests are in it
+        roundTrips = sum(n for op,n in backend.callCounts.items() if op != 'drive.batch')
+        roundTrips += -(-backend.callCounts.get('drive.batch',0) // sar.DRIVE_BATCH_SIZE)
+        return {'size' : size,'processed' : len(processed),'roundTrips' : roundTrips,
+                'driveUnits' : driveUnits,'sheetsUnits' : sheetsUnits,
+                'wallTime' : wallTime,'peakMemory' : peakMemory,
+                'callCounts' : dict(backend.callCounts),'stages' : metrics.summary()['stages']}
+    finally:
+        shutil.rmtree(stateDir,ignore_errors=True)
+
+
+def scaleOutWorker(sar,statePath,stateDir,workerNo,latency,results):
+    '''one worker process: runs the process until a run finds nothing left for it'''
+    workerDir = os.path.join(stateDir,'worker' + str(workerNo))
+    os.makedirs(workerDir)
+    sar.config.read_dict({
+        'State' : {'watermarkFile' : os.path.join(workerDir,'watermark.json'),
+                   'indexFile' : os.path.join(workerDir,'index.sqlite'),
+                   'journalFile' : os.path.join(workerDir,'journal.jsonl')},
+        'Templates' : {'cacheDir' : os.path.join(workerDir,'templates')},
+        'Scale Out' : {'enabled' : 'yes','workerId' : 'worker' + str(workerNo),'claimBatchSize' : '10'}})
+    backend = sar.SharedFileBackend(statePath,latency=latency)
+    logger = sar.SheetLogger(backend,'log-sheet',append=True)
+    processed = []
+    while True:
+        done = sar.runSarProcess(backend,logger)
+        if not done:
+            break
+        processed.extend(rec['_sheetRow'] for rec in done)
+    results.put((workerNo,processed,sum(backend.callCounts.values())))
+
+
+def runScaleOut(sar,size,workers,latency,localTemplates=False):
+    '''works through size pending requests with several worker processes and checks
+    that every row was processed once and no reference got two folders'''
+    stateDir = tempfile.mkdtemp()
+    try:
+        statePath = os.path.join(stateDir,'backend.json')
+        sar.config.clear()
+        sar.config.read_dict(benchmarkConfig(sar,stateDir,False,localTemplates))
+        backend = sar.SharedFileBackend.fromConfig(sar.config,statePath=statePath)
+        formSheet = backend.files['dsar-form']['sheets'][0]
+        formSheet.rows.extend(pendingFormRows(size))
+        formSheet.row_count = max(formSheet.row_count,len(formSheet.rows))
+        backend.saveState()
+
+        #the workers are forked so they start with the config and the script already loaded
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        started = time.perf_counter()
+        processes = [context.Process(target=scaleOutWorker,args=(sar,statePath,stateDir,n,latency,results))
+                     for n in range(workers)]
+        for process in processes:
+            process.start()
+        workerResults = sorted(results.get() for process in processes)
+        for process in processes:
+            process.join()
+        wallTime = time.perf_counter() - started
+
+        with open(statePath) as f:
+            files = json.load(f)['files']
+        formRows = files['dsar-form']['sheets'][0]['rows'][1:]
+        processedRows = [rowNo for workerNo,rows,calls in workerResults for rowNo in rows]
+        folderNames = [f['name'] for f in files.values()
+                       if f['mimeType'] == sar.FOLDER_MIME_TYPE and f['parents']]
+        return {'size' : size,'workers' : workers,'wallTime' : wallTime,
+                'perWorker' : [(workerNo,len(rows),calls) for workerNo,rows,calls in workerResults],
+                'processedTwice' : len(processedRows) - len(set(processedRows)),
+                'unstamped' : sum(1 for row in formRows if not row[2].startswith('Processed')),
+                'duplicateFolders' : len(folderNames) - len(set(folderNames))}
+    finally:
+        shutil.rmtree(stateDir,ignore_errors=True)
+
+
+def printScaleOutReport(result):
+    print('%d requests over %d workers in %.2fs' % (result['size'],result['workers'],result['wallTime']))
+    print('%8s %10s %8s' % ('worker','processed','calls'))
+    for workerNo,processed,calls in result['perWorker']:
+        print('%8d %10d %8d' % (workerNo,processed,calls))
+    print('processed twice: %d  left unstamped: %d  duplicate folders: %d' % (
+        result['processedTwice'],result['unstamped'],result['duplicateFolders']))
+
+
+def printReport(results):
+    print('%8s %10s %12s %12s %12s %12s %10s %12s' % ('requests','processed','calls','calls/req',
+                                                       'drive units','sheet units','wall s','peak KiB'))
+    for r in results:
+        print('%8d %10d %12d %12.2f %12d %12d %10.2f %12d' % (
+            r['size'],r['processed'],r['roundTrips'],r['roundTrips'] / float(r['size']),
+            r['driveUnits'],r['sheetsUnits'],r['wallTime'],r['peakMemory'] // 1024))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure what a SAR run costs as the backlog grows')
+    parser.add_argument('--sizes',type=int,nargs='+',default=[1,10,100,1000],
+                        help='numbers of pending requests to run with')
+    parser.add_argument('--latency',type=float,default=0.01,
+                        help='seconds every simulated API call takes')
+    parser.add_argument('--parallel',action='store_true',
+                        help='turn on the parallel request and input sheet modes')
+    parser.add_argument('--local-templates',action='store_true',
+                        help='fill the templates in locally and upload them ([Templates] renderLocally)')
+    parser.add_argument('--scale-out',type=int,default=0,metavar='N',
+                        help='work through the first size with N worker processes claiming rows')
+    parser.add_argument('--verbose',action='store_true',help='print the calls made per operation')
+    args = parser.parse_args(argv)
+
+    sar = loadSarScript()
+    if args.scale_out:
+        result = runScaleOut(sar,args.sizes[0],args.scale_out,args.latency,args.local_templates)
+        printScaleOutReport(result)
+        return 0 if not (result['processedTwice'] or result['unstamped'] or result['duplicateFolders']) else 1
+    results = []
+    for size in args.sizes:
+        result = runOnce(sar,size,args.latency,args.parallel,args.local_templates)
+        results.append(result)
+        if args.verbose:
+            print(size,'requests:',result['callCounts'],file=sys.stderr)
+            for stage,info in sorted(result['stages'].items()):
+                print('   %-20s %6d calls %8.2fs' % (stage,info['calls'],info.get('seconds',0.0)),file=sys.stderr)
+    printReport(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,629 @@
+'''runs the whole SAR process against the in-memory backend: a run that dies part way
+through and is resumed, quarantined form rows, the watermark, the log sheet and two
+workers sharing the form sheet through the claim log'''
+
+import json,os,re,sys,threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime,timedelta
+
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sar_benchmark
+
+sar = sar_benchmark.loadSarScript()
+
+
+class Crash(BaseException):
+    '''the process dying part way through a run. It is not an Exception so nothing in the
+    script can catch it and carry on'''
+
+
+@pytest.fixture
+def stateDir(tmp_path):
+    sar.config.clear()
+    sar.config.read_dict(sar_benchmark.benchmarkConfig(sar,str(tmp_path),False))
+    return tmp_path
+
+
+class FakeDriveRequest(object):
+    def __init__(self,run):
+        self.run = run
+
+    def execute(self):
+        return self.run()
+
+
+class FakeDriveBatch(object):
+    def __init__(self,drive,callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self,request,callback=None,request_id=None):
+        self.requests.append((request_id,request))
+
+    def execute(self):
+        failure = self.drive.batchFailures.pop(0) if self.drive.batchFailures else None
+        if failure == 'before':
+            raise sar.SimulatedApiError(429,'Rate Limit Exceeded')
+        for requestId,request in self.requests:
+            self.callback(requestId,request.execute(),None)
+        if failure == 'after':
+            raise sar.SimulatedApiError(503,'Service Unavailable')
+
+
+class FakeDriveFiles(object):
+    def __init__(self,drive):
+        self.drive = drive
+
+    def create(self,body=None,fields=None):
+        def createIt():
+            created = self.drive.create(body)
+            if self.drive.createFailures:
+                #the file was made but the answer never came back
+                raise self.drive.createFailures.pop(0)
+            return created
+        return FakeDriveRequest(createIt)
+
+    def list(self,q=None,**kwargs):
+        return FakeDriveRequest(lambda: {'files' : self.drive.search(q)})
+
+
+class FakeDrive(object):
+    '''just enough of a Drive service for createGDriveSubFolders and findGDriveFile.
+    batchFailures says what each batch does: None, 'before' - a 429 before anything is
+    made - or 'after' - a 503 once every folder has been made. createFailures are raised by
+    single creates after they have made their file'''
+
+    def __init__(self,batchFailures=(),createFailures=()):
+        self.batchFailures = list(batchFailures)
+        self.createFailures = list(createFailures)
+        self.made = []
+
+    def files(self):
+        return FakeDriveFiles(self)
+
+    def new_batch_http_request(self,callback=None):
+        return FakeDriveBatch(self,callback)
+
+    def create(self,body):
+        self.made.append({'id' : 'folder' + str(len(self.made) + 1),'name' : body['name'],
+                          'parents' : body['parents']})
+        return {'id' : self.made[-1]['id']}
+
+    def search(self,query):
+        match = re.search(r"name = '(.*?)' and '(.*?)' in parents",query)
+        if match is None:
+            return list(self.made)
+        name,parentId = match.groups()
+        return [{'id' : f['id']} for f in self.made if f['name'] == name and parentId in f['parents']]
+
+
+def newBackend(pendingRows=0):
+    backend = sar.MemoryBackend.fromConfig(sar.config)
+    submitRows(backend,sar_benchmark.pendingFormRows(pendingRows))
+    return backend
+
+
+def submitRows(backend,rows):
+    formSheet = backend.files['dsar-form']['sheets'][0]
+    formSheet.rows.extend(rows)
+    formSheet.row_count = max(formSheet.row_count,len(formSheet.rows))
+    backend.touch('dsar-form')
+
+
+def useWorker(stateDir,workerId,leaseSeconds=900):
+    '''points the state files at the worker's own directory and runs as that worker'''
+    workerDir = stateDir / workerId
+    workerDir.mkdir(exist_ok=True)
+    sar.config.read_dict({
+        'State' : {'watermarkFile' : str(workerDir / 'watermark.json'),
+                   'indexFile' : str(workerDir / 'index.sqlite'),
+                   'journalFile' : str(workerDir / 'journal.jsonl')},
+        'Scale Out' : {'enabled' : 'yes','workerId' : workerId,'leaseSeconds' : str(leaseSeconds)}})
+
+
+def crashOnCall(backend,methodName,callNo):
+    '''makes the backend method die on its callNo-th call'''
+    method = getattr(backend,methodName)
+    calls = []
+    def crashing(*args,**kwargs):
+        calls.append(args)
+        if len(calls) == callNo:
+            raise Crash()
+        return method(*args,**kwargs)
+    setattr(backend,methodName,crashing)
+
+
+def runProcess(backend,appendLog=False):
+    return [rec['_sheetRow'] for rec in
+            sar.runSarProcess(backend,sar.SheetLogger(backend,'log-sheet',append=appendLog))]
+
+
+def getArtifacts(backend):
+    '''the names of the folders and templates made for requests and the rows of every input sheet'''
+    parents = ('sar-parent','delete-parent')
+    folders = dict((f['id'],f['name']) for f in backend.files.values()
+                   if f['mimeType'] == sar.FOLDER_MIME_TYPE and set(f['parents']) & set(parents))
+    templates = [f['name'] for f in backend.files.values() if set(f['parents']) & set(folders)]
+    inputRows = dict((route[0],backend.files['input-' + route[0]]['sheets'][0].rows)
+                     for route in sar.DEFAULT_INPUT_ROUTES)
+    return sorted(folders.values()),sorted(templates),inputRows
+
+
+def readJournal(path):
+    with open(str(path)) as f:
+        return [json.loads(line) for line in f]
+
+
+def getProcessedColumn(backend):
+    return [row[2] for row in backend.files['dsar-form']['sheets'][0].rows[1:]]
+
+
+def getExpectedArtifacts(stateDir,pendingRows):
+    '''what a run over the same form rows that does not die leaves behind'''
+    sar.config.read_dict({'State' : {'watermarkFile' : str(stateDir / 'clean-watermark.json'),
+                                     'indexFile' : str(stateDir / 'clean-index.sqlite'),
+                                     'journalFile' : str(stateDir / 'clean-journal.jsonl')}})
+    backend = newBackend(pendingRows)
+    runProcess(backend)
+    sar.config.read_dict(sar_benchmark.benchmarkConfig(sar,str(stateDir),False))
+    return getArtifacts(backend)
+
+
+@pytest.mark.parametrize('methodName,callNo',[('copyFile',2),('openWorksheet',5)])
+def test_resumed_run_makes_nothing_twice(stateDir,methodName,callNo):
+    expected = getExpectedArtifacts(stateDir,3)
+    backend = newBackend(3)
+    crashOnCall(backend,methodName,callNo)
+    with pytest.raises(Crash):
+        runProcess(backend)
+    assert readJournal(stateDir / 'journal.jsonl')
+
+    backend.copyFile = sar.MemoryBackend.copyFile.__get__(backend)
+    backend.openWorksheet = sar.MemoryBackend.openWorksheet.__get__(backend)
+    runProcess(backend)
+
+    assert getArtifacts(backend) == expected
+    assert all(value.startswith('Processed') for value in getProcessedColumn(backend))
+    #every record went through every stage so the journal is compacted away
+    assert readJournal(stateDir / 'journal.jsonl') == []
+
+
+def test_quarantined_rows_are_stamped_and_passed(stateDir):
+    rows = sar_benchmark.pendingFormRows(3)
+    #an access request with no S-Number
+    rows[0][6] = ''
+    backend = newBackend()
+    submitRows(backend,rows)
+
+    assert runProcess(backend) == [3,4]
+
+    processedColumn = getProcessedColumn(backend)
+    assert processedColumn[0].startswith('Quarantined')
+    assert processedColumn[0].endswith('missing If DSAR Please Enter Next S-Number:')
+    with open(str(stateDir / 'watermark.json')) as f:
+        assert json.load(f)['lastProcessedRow'] == 4
+    assert runProcess(backend) == []
+    assert readJournal(stateDir / 'journal.jsonl') == []
+
+
+def test_rows_sharing_a_reference_are_quarantined(stateDir):
+    rows = sar_benchmark.pendingFormRows(3)
+    #the third row, a Both request, is given the first row's S-Number
+    rows[2][6] = rows[0][6]
+    backend = newBackend()
+    submitRows(backend,rows)
+
+    assert runProcess(backend) == [2,3]
+    processedColumn = getProcessedColumn(backend)
+    assert processedColumn[2].startswith('Quarantined')
+    assert processedColumn[2].endswith(': S1000 already used by form row 2')
+    folders,templates,inputRows = getArtifacts(backend)
+    assert len([name for name in folders if name.startswith('S1000')]) == 1
+    assert not any('D5002' in str(row) for rows in inputRows.values() for row in rows)
+
+    #a later row with a D-Number the artifact index has already
+    laterRow = sar_benchmark.pendingFormRows(2)[1]
+    submitRows(backend,[laterRow])
+    assert runProcess(backend) == []
+    assert getProcessedColumn(backend)[3].endswith(': D5001 already used by form row 3')
+
+
+def test_watermark_reads_only_new_rows(stateDir):
+    backend = newBackend(2)
+    assert runProcess(backend) == [2,3]
+
+    submitRows(backend,sar_benchmark.pendingFormRows(4)[2:])
+    formSheet = backend.files['dsar-form']['sheets'][0]
+    readRanges = []
+    batchGet = formSheet.batch_get
+    def recordingBatchGet(ranges,**kwargs):
+        readRanges.append(list(ranges))
+        return batchGet(ranges,**kwargs)
+    formSheet.batch_get = recordingBatchGet
+    assert runProcess(backend) == [4,5]
+    assert readRanges[0] == ['1:1','4:' + str(formSheet.row_count)]
+
+    #the run after our own stamps reads past the watermark once and then the sheet is unchanged
+    assert runProcess(backend) == []
+    backend.callCounts.clear()
+    assert sar.runSarProcess(backend,sar.SheetLogger(backend,'log-sheet'),quiet=True) == []
+    assert backend.callCounts == {'drive.files.get' : 1}
+
+
+def test_logger_keeps_lines_after_failed_flush(stateDir):
+    backend = newBackend()
+    logSheet = backend.files['log-sheet']['sheets'][0]
+    colValues = logSheet.col_values
+    failures = [sar.SimulatedApiError(500,'Backend Error')]
+    def failingColValues(col):
+        if failures:
+            raise failures.pop()
+        return colValues(col)
+    logSheet.col_values = failingColValues
+
+    logger = sar.SheetLogger(backend,'log-sheet')
+    logger.log('one')
+    logger.flush()
+    assert logger.pending == ['one']
+    assert logSheet.rows == []
+
+    logger.log('two')
+    logger.flush()
+    logger.log('three')
+    logger.flush()
+    assert logger.pending == []
+    assert logSheet.rows == [['one'],['two'],['three']]
+
+
+@pytest.mark.parametrize('batchFailures',[['before'],['after'],['after','after','after','after']])
+def test_failed_folder_batch_makes_each_folder_once(monkeypatch,batchFailures):
+    monkeypatch.setattr(sar.time,'sleep',lambda seconds: None)
+    drive = FakeDrive(batchFailures)
+    folderRequests = [('S' + str(i),'sar-parent','S' + str(i) + ' - Open') for i in range(3)]
+
+    folderIds,folderErrors = sar.createGDriveSubFolders(sar.GuardedDriveService(drive,sar.ApiGuard({})),
+                                                        folderRequests)
+
+    assert folderErrors == {}
+    assert sorted(f['name'] for f in drive.made) == sorted(name for ref,parentId,name in folderRequests)
+    assert sorted(folderIds.values()) == sorted(f['id'] for f in drive.made)
+
+
+class FlakyCall(object):
+    '''a call that raises each of errors in turn before it works, counting its attempts'''
+
+    def __init__(self,errors):
+        self.errors = list(errors)
+        self.attempts = 0
+
+    def __call__(self):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'sent'
+
+
+SERVER_ERROR = sar.SimulatedApiError(503,'Service Unavailable')
+RATE_LIMIT = sar.SimulatedApiError(429,'Rate Limit Exceeded')
+
+
+@pytest.mark.parametrize('opName,error,recovered,result,attempts,lookups',[
+    #a create that may have gone through is looked for and not sent again if found
+    ('drive.files.create',SERVER_ERROR,'found','found',1,1),
+    ('drive.files.create',SERVER_ERROR,None,'sent',2,1),
+    #a rate limit means nothing was done, so it is sent again without looking
+    ('drive.files.create',RATE_LIMIT,'found','sent',2,0),
+    #calls that are safe to repeat are just sent again
+    ('drive.files.get',SERVER_ERROR,'found','sent',2,0)])
+def test_guard_looks_before_resending(opName,error,recovered,result,attempts,lookups):
+    guard = sar.ApiGuard({},baseDelay=0)
+    call = FlakyCall([error])
+    recoverCalls = []
+    def recover():
+        recoverCalls.append(opName)
+        return recovered
+
+    assert guard.call('drive',opName,call,recover=recover) == result
+    assert call.attempts == attempts
+    assert len(recoverCalls) == lookups
+
+
+def test_guard_does_not_resend_what_it_cannot_look_for():
+    guard = sar.ApiGuard({},baseDelay=0)
+    call = FlakyCall([SERVER_ERROR])
+    with pytest.raises(sar.SimulatedApiError):
+        guard.call('sheets.write','sheets.append_rows',call)
+    assert call.attempts == 1
+
+    def brokenRecover():
+        raise RATE_LIMIT
+    call = FlakyCall([SERVER_ERROR])
+    with pytest.raises(sar.SimulatedApiError) as raised:
+        guard.call('drive','drive.files.copy',call,recover=brokenRecover)
+    assert raised.value is SERVER_ERROR
+    assert call.attempts == 1
+    assert guard.snapshot()['failed'] == 2
+
+
+def test_guarded_create_finds_the_folder_it_made():
+    drive = FakeDrive(createFailures=[SERVER_ERROR])
+    gService = sar.GuardedDriveService(drive,sar.ApiGuard({},baseDelay=0))
+
+    newFolder = sar.createGDriveSubFolder(gService,'sar-parent','S1 - Open')
+
+    assert [f['name'] for f in drive.made] == ['S1 - Open']
+    assert newFolder == {'id' : drive.made[0]['id']}
+
+
+def test_input_rows_appended_once_after_server_error(stateDir):
+    backend = newBackend()
+    inputSheet = backend.files['input-TempPen']['sheets'][0]
+    appendRows = inputSheet.append_rows
+    def appendThenFail(values,**kwargs):
+        inputSheet.append_rows = appendRows
+        appendRows(values,**kwargs)
+        raise SERVER_ERROR
+    inputSheet.append_rows = appendThenFail
+
+    sar.fillInputSheet(backend,[['a@example.com','S1'],['b@example.com','S2']],'input-TempPen',append=True)
+    sar.fillInputSheet(backend,[['c@example.com','S3']],'input-TempPen',append=True)
+
+    assert inputSheet.rows == [['a@example.com','S1'],['b@example.com','S2'],['c@example.com','S3']]
+
+
+def test_drive_clients_are_kept_between_thread_pools():
+    madeClients = []
+    def driveFactory():
+        madeClients.append(FakeDrive())
+        return madeClients[-1]
+    backend = sar.GoogleBackend(driveFactory,None,sar.ApiGuard({}))
+    #every worker is in a call at the same time, so each needs its own client
+    barrier = threading.Barrier(4)
+    def listFolders(drive):
+        barrier.wait()
+        return sar.listGDriveFiles(drive,"'sar-parent' in parents")
+
+    for run in range(3):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(lambda workerNo: backend.withDrive(listFolders),range(4)))
+        assert len(madeClients) == 4
+    assert backend.listFiles(parentFolderId='sar-parent') == []
+    assert len(madeClients) == 4
+
+
+def test_daemon_backs_off_retrying_a_failing_request(stateDir,monkeypatch):
+    backend = newBackend(1)
+    #the request can never be finished while an input sheet is missing
+    del backend.files['input-TempPen']
+    polls = []
+    getModifiedTime = backend.getModifiedTime
+    def countedPoll(fileId):
+        polls.append(fileId)
+        return getModifiedTime(fileId)
+    backend.getModifiedTime = countedPoll
+    runs = []
+    def countedRun(backend,logger,formModifiedTime=None,**kwargs):
+        runs.append(formModifiedTime)
+        return sar.runSarProcess(backend,logger,formModifiedTime=formModifiedTime)
+    monkeypatch.setattr(sar,'runWithMetrics',countedRun)
+    stopHandlers = {}
+    monkeypatch.setattr(sar.signal,'signal',lambda signum,handler: stopHandlers.setdefault(signum,handler))
+    stopper = threading.Timer(0.6,lambda: stopHandlers[sar.signal.SIGTERM](None,None))
+    stopper.start()
+
+    sar.runDaemon(backend,sar.SheetLogger(backend,'log-sheet'),pollSeconds=0.01,maxRetrySeconds=10)
+
+    #without the backoff it would be a run every poll
+    assert 2 <= len(runs) < len(polls) / 2
+    assert sar.openStageJournal().unfinishedRecords()
+
+
+def test_live_lease_keeps_other_worker_off(stateDir):
+    backend = newBackend(2)
+    useWorker(stateDir,'A')
+    crashOnCall(backend,'copyFile',1)
+    with pytest.raises(Crash):
+        runProcess(backend,appendLog=True)
+
+    useWorker(stateDir,'B')
+    assert runProcess(backend,appendLog=True) == []
+    assert getProcessedColumn(backend) == ['','']
+
+
+def test_expired_lease_is_taken_over_once(stateDir):
+    expected = getExpectedArtifacts(stateDir,1)
+    backend = newBackend(1)
+    #A's lease runs out as soon as it is taken
+    useWorker(stateDir,'A',leaseSeconds=0)
+    crashOnCall(backend,'copyFile',1)
+    with pytest.raises(Crash):
+        runProcess(backend,appendLog=True)
+    backend.copyFile = sar.MemoryBackend.copyFile.__get__(backend)
+
+    useWorker(stateDir,'B')
+    assert runProcess(backend,appendLog=True) == [2]
+
+    #A comes back with the row unfinished in its journal but B holds it now
+    useWorker(stateDir,'A')
+    assert runProcess(backend,appendLog=True) == []
+
+    assert getArtifacts(backend) == expected
+    assert readJournal(stateDir / 'A' / 'journal.jsonl') == []
+    assert readJournal(stateDir / 'B' / 'journal.jsonl') == []
+
+
+def addClaim(backend,rowNo,workerId,claimedAt,expiry):
+    backend.files['claim-log']['sheets'][0].rows.append(
+        [rowNo,workerId,claimedAt.strftime(sar.CLAIM_TIME_FORMAT),expiry.strftime(sar.CLAIM_TIME_FORMAT)])
+
+
+def test_lease_lost_during_a_run_is_left_to_its_new_holder(stateDir):
+    expected = getExpectedArtifacts(stateDir,1)
+    backend = newBackend(1)
+    useWorker(stateDir,'A',leaseSeconds=0)
+    copyFile = backend.copyFile
+    def slowCopyFile(*args,**kwargs):
+        #A is held up past its lease and B takes the row over meanwhile
+        now = datetime.utcnow()
+        addClaim(backend,2,'B',now,now + timedelta(seconds=900))
+        backend.copyFile = copyFile
+        return copyFile(*args,**kwargs)
+    backend.copyFile = slowCopyFile
+
+    assert runProcess(backend,appendLog=True) == []
+    assert getProcessedColumn(backend) == ['']
+    assert getArtifacts(backend)[2] == dict((route[0],[]) for route in sar.DEFAULT_INPUT_ROUTES)
+    assert readJournal(stateDir / 'A' / 'journal.jsonl') == []
+
+    useWorker(stateDir,'B')
+    assert runProcess(backend,appendLog=True) == [2]
+    assert getArtifacts(backend) == expected
+
+
+def test_claim_log_is_pruned_by_one_worker(stateDir):
+    sar.config.read_dict({'Scale Out' : {'workerId' : 'A','claimLogPruneLines' : '2'}})
+    backend = newBackend()
+    now = datetime.utcnow().replace(microsecond=0)
+    addClaim(backend,2,'A',now - timedelta(seconds=100),now - timedelta(seconds=50))
+    addClaim(backend,3,'B',now - timedelta(seconds=100),now - timedelta(seconds=50))
+    addClaim(backend,4,'A',now - timedelta(seconds=10),now + timedelta(seconds=900))
+    addClaim(backend,3,'A',now - timedelta(seconds=10),now - timedelta(seconds=5))
+    claimLog = backend.files['claim-log']['sheets'][0]
+
+    #another worker is pruning
+    addClaim(backend,sar.CLAIM_LOG_PRUNE_ROW,'B',now,now + timedelta(seconds=900))
+    assert sar.pruneClaimLog(backend,3) == 0
+    assert len(claimLog.rows) == 7
+
+    claimLog.rows.pop()
+    claimLog.rows.pop()
+    assert sar.pruneClaimLog(backend,3) == 2
+    assert [line[:2] for line in claimLog.rows] == [sar.CLAIM_LOG_HEADER[:2],[4,'A'],[3,'A'],
+                                                    [sar.CLAIM_LOG_PRUNE_ROW,'A']]
+    assert sar.readClaimHolders(claimLog)[4][0] == 'A'
+
+
+def test_row_stamped_before_its_claim_is_left_alone(stateDir,monkeypatch):
+    backend = newBackend(1)
+    useWorker(stateDir,'B')
+    claimFormRows = sar.claimFormRows
+    def claimAfterStamp(*args,**kwargs):
+        #another worker stamps the row after B read the form sheet and before B claims it
+        backend.files['dsar-form']['sheets'][0].rows[1][2] = 'Processed by A'
+        return claimFormRows(*args,**kwargs)
+    monkeypatch.setattr(sar,'claimFormRows',claimAfterStamp)
+
+    assert runProcess(backend,appendLog=True) == []
+    assert getArtifacts(backend)[0] == []
+
+
+def test_input_routes_are_changed_and_added_by_config(stateDir):
+    sar.config.read_dict({'Input Route Salesforce' : {'columns' : 'ref, name, Received Date:','requires' : 'identity'},
+                          'Input Route Zuora' : {'enabled' : 'no'},
+                          'Input Route BigQuery' : {'columns' : 'identity, ref'},
+                          'Input File Ids' : {'salesforceInputSheetId' : 'input-Salesforce'}})
+    routes = dict((route.name,route) for route in sar.getInputRoutes(sar.config))
+    assert 'Zuora' not in routes
+    assert (routes['Salesforce'].sheetIdKey,routes['Salesforce'].requires) == ('salesforceInputSheetId',['identity'])
+    #a changed sheet keeps what the section does not set
+    assert (routes['BigQuery'].columns,routes['BigQuery'].requires) == (['identity','ref'],['identity'])
+
+    backend = newBackend(2)
+    assert runProcess(backend) == [2,3]
+    #only the first request has an identity
+    assert backend.files['input-Salesforce']['sheets'][0].rows == [['S1000','Subject 0','18/03/2019']]
+    assert backend.files['input-BigQuery']['sheets'][0].rows == [[15000000,'S1000']]
+    assert 'input-Zuora' not in backend.files
+
+
+def test_new_input_route_needs_columns(stateDir):
+    sar.config.read_dict({'Input Route Salesforce' : {'requires' : 'identity'}})
+    with pytest.raises(ValueError):
+        sar.getInputRoutes(sar.config)
+
+
+def test_artifact_index_is_recorded_and_rebuilt_from_drive(stateDir):
+    backend = newBackend(3)
+    assert runProcess(backend) == [2,3,4]
+    index = sar.openArtifactIndex()
+    recorded = dict((entry['ref'],entry) for entry in index.list())
+    assert sorted(recorded) == ['D5001','D5002','S1000','S1002']
+    assert [entry['ref'] for entry in index.list(action='Delete')] == ['D5001','D5002']
+    entry = index.lookup('S1002')
+    assert entry['form_row'] == 4
+    assert backend.files[entry['folder_id']]['name'].startswith('S1002')
+    assert backend.files[entry['template_file_id']]['parents'] == [entry['folder_id']]
+    assert index.lookup('S9999') is None
+
+    #a new machine has no index, and one with an index keeps its form rows
+    fresh = sar.ArtifactIndex(str(stateDir / 'fresh.sqlite'))
+    for rebuilt in (fresh,index):
+        assert rebuilt.rebuild(backend) == 4
+        for ref,entry in recorded.items():
+            found = rebuilt.lookup(ref)
+            assert (found['action'],found['folder_id'],found['template_file_id']) == \
+                   (entry['action'],entry['folder_id'],entry['template_file_id'])
+            assert found['form_row'] == (entry['form_row'] if rebuilt is index else None)
+        rebuilt.close()
+
+
+def writeExport(path,rows):
+    import csv
+    with open(str(path),'w',newline='') as f:
+        csv.writer(f).writerows([sar.DSAR_FORM_HEADER] + rows)
+    return str(path)
+
+
+def runBackfill(backend,exportPath,journalPath):
+    index = sar.openArtifactIndex()
+    try:
+        return sar.runBackfill(backend,sar.SheetLogger(backend,'log-sheet',append=True),exportPath,
+                               sar.StageJournal(str(journalPath)),index,maxWorkers=1)
+    finally:
+        index.close()
+
+
+def test_backfill_skips_indexed_requests_and_rejects_incomplete_rows(stateDir):
+    backend = newBackend(2)
+    assert runProcess(backend) == [2,3]
+    rows = sar_benchmark.pendingFormRows(4)
+    #an access request with no S-Number
+    rows[3][6] = ''
+    exportPath = writeExport(stateDir / 'export.csv',rows)
+
+    counts = runBackfill(backend,exportPath,stateDir / 'backfill.jsonl')
+    assert counts == {'read' : 4,'imported' : 1,'skipped' : 2,'rejected' : 1,'failed' : 0}
+    artifacts = getArtifacts(backend)
+    assert artifacts[0] == ['D5001 - Open','D5002 - Open','S1000 - Open','S1002 - Open']
+    #backfill rows are never stamped on the form sheet
+    assert getProcessedColumn(backend)[2:] == []
+
+    #loading the same file again makes nothing
+    counts = runBackfill(backend,exportPath,stateDir / 'backfill.jsonl')
+    assert counts == {'read' : 4,'imported' : 0,'skipped' : 3,'rejected' : 1,'failed' : 0}
+    assert getArtifacts(backend) == artifacts
+
+
+@pytest.mark.parametrize('methodName,callNo',[('copyFile',2),('openWorksheet',2)])
+def test_resumed_backfill_makes_nothing_twice(stateDir,methodName,callNo):
+    exportPath = writeExport(stateDir / 'export.csv',sar_benchmark.pendingFormRows(3))
+    sar.config.read_dict({'State' : {'indexFile' : str(stateDir / 'clean-index.sqlite')}})
+    clean = newBackend()
+    runBackfill(clean,exportPath,stateDir / 'clean-backfill.jsonl')
+    sar.config.read_dict(sar_benchmark.benchmarkConfig(sar,str(stateDir),False))
+
+    backend = newBackend()
+    crashOnCall(backend,methodName,callNo)
+    with pytest.raises(Crash):
+        runBackfill(backend,exportPath,stateDir / 'backfill.jsonl')
+    assert readJournal(stateDir / 'backfill.jsonl')
+
+    setattr(backend,methodName,getattr(sar.MemoryBackend,methodName).__get__(backend))
+    counts = runBackfill(backend,exportPath,stateDir / 'backfill.jsonl')
+    #the records accepted before the crash are picked up from the journal and finished
+    assert counts['imported'] == 3 and counts['skipped'] == 0
+    assert getArtifacts(backend) == getArtifacts(clean)
+    assert readJournal(stateDir / 'backfill.jsonl') == []